@@ -1,3 +1,4 @@
+import threading
 import numpy as np
 
 import glfw
@@ -33,7 +34,13 @@ VIEWER_STATE = {
     },
 
     'mesh_cache': None,
-    'mesh': None
+    'mesh': None,
+
+    'load': {
+        'lock': threading.Lock(),
+        'generation': 0,
+        'pending': None
+    }
 }
 
 
@@ -262,11 +269,53 @@ def key_callback(window, key, scancode, action, mods):
             else:
                 VIEWER_STATE['mesh'] = VIEWER_STATE['mesh_cache']
 
-def drop_callback(window, cbfun):
-    fname = cbfun[0]
 
-    mesh = ObjMeshLoader.from_file(fname, force_smooth=VIEWER_STATE['force_smooth'])
+class LoadCancelled(Exception):
+    pass
+
+
+def print_progress(done, total):
+    print('\rLoading... %3d%%' % (100 * done // max(total, 1)), end='', flush=True)
+
+
+def load_worker(generation, fname, force_smooth):
+    def progress(done, total):
+        # a newer drop supersedes this load
+        if generation != VIEWER_STATE['load']['generation']:
+            raise LoadCancelled()
+
+        print_progress(done, total)
+
+    try:
+        mesh = ObjMeshLoader.from_file(fname, force_smooth=force_smooth, progress=progress)
+    except LoadCancelled:
+        return
+    except Exception as e:
+        print()
+        print('<Exception while loading %s>' % fname)
+        print(e)
+        return
+
+    with VIEWER_STATE['load']['lock']:
+        if generation == VIEWER_STATE['load']['generation']:
+            VIEWER_STATE['load']['pending'] = (fname, mesh, force_smooth)
+
+
+def process_loaded_mesh():
+    with VIEWER_STATE['load']['lock']:
+        pending = VIEWER_STATE['load']['pending']
+        VIEWER_STATE['load']['pending'] = None
+
+    if pending is None:
+        return
+
+    fname, mesh, force_smooth = pending
+
+    # shading was toggled while loading
+    if force_smooth != VIEWER_STATE['force_smooth']:
+        mesh.build(force_smooth=VIEWER_STATE['force_smooth'])
 
+    print()
     print('[Load OBJ]')
     print('Filename: %s' % fname)
     print('Total number of faces: %d' % mesh.n_faces)
@@ -280,6 +329,20 @@ def drop_callback(window, cbfun):
         VIEWER_STATE['mesh'] = mesh
 
 
+def drop_callback(window, cbfun):
+    fname = cbfun[0]
+
+    # parse in the background; the previous model keeps rendering and the
+    # GL upload happens on the main thread once the worker is done
+    with VIEWER_STATE['load']['lock']:
+        VIEWER_STATE['load']['generation'] += 1
+        VIEWER_STATE['load']['pending'] = None
+        generation = VIEWER_STATE['load']['generation']
+
+    threading.Thread(target=load_worker, daemon=True,
+                     args=(generation, fname, VIEWER_STATE['force_smooth'])).start()
+
+
 def main():
     # Initialize GLFW
     if not glfw.init():
@@ -303,6 +366,7 @@ def main():
     while not glfw.window_should_close(window):
         glfw.poll_events()
 
+        process_loaded_mesh()
         render()
 
         glfw.swap_buffers(window)
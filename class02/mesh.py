@@ -1,7 +1,15 @@
 import ctypes
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
 import numpy as np
 
 from OpenGL.GL import *
+from OpenGL.arrays import vbo
+
+import meshcache
 
 
 class Transform:
@@ -20,6 +28,75 @@ class Transform:
         glTranslatef(*self.translate)
 
 
+class GrowableArray:
+    def __init__(self, width, dtype, capacity=64):
+        self.data = np.empty((capacity, width), dtype=dtype)
+        self.size = 0
+
+    def reserve(self, capacity):
+        if capacity <= len(self.data):
+            return
+
+        # grow geometrically so appends stay amortized O(1)
+        data = np.empty((max(capacity, 2 * len(self.data)), self.data.shape[1]),
+                        dtype=self.data.dtype)
+        data[:self.size] = self.data[:self.size]
+        self.data = data
+
+    def append(self, row):
+        self.reserve(self.size + 1)
+        self.data[self.size] = row
+        self.size += 1
+
+    def extend(self, rows):
+        self.reserve(self.size + len(rows))
+        self.data[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+
+    def view(self):
+        return self.data[:self.size]
+
+    @staticmethod
+    def wrap(arr):
+        # use arr as storage without copying; it is copied on the next growth
+        buf = GrowableArray.__new__(GrowableArray)
+        buf.data = arr
+        buf.size = len(arr)
+        return buf
+
+    def __len__(self):
+        return self.size
+
+
+def smooth_normals(vertices, vindices, weight='uniform'):
+    # weight: 'uniform' (every face counts the same), 'area' or 'angle'
+    corners = vertices[vindices]
+    edges = np.roll(corners, -1, axis=1) - corners
+
+    face_normals = np.cross(edges[:, 0], -edges[:, 2])
+    if weight != 'area':
+        length = np.linalg.norm(face_normals, axis=1, keepdims=True)
+        face_normals /= np.maximum(length, 1e-12)
+
+    contrib = np.repeat(face_normals[:, None], 3, axis=1)
+    if weight == 'angle':
+        e1 = edges / np.maximum(np.linalg.norm(edges, axis=2, keepdims=True), 1e-12)
+        e2 = -np.roll(e1, 1, axis=1)
+        angle = np.arccos(np.clip(np.sum(e1 * e2, axis=2), -1., 1.))
+        contrib *= angle[:, :, None]
+
+    # scatter-add every corner contribution into its vertex
+    idx = vindices.ravel()
+    contrib = contrib.reshape(-1, 3)
+    normals = np.stack([np.bincount(idx, weights=contrib[:, k], minlength=len(vertices))
+                        for k in range(3)], axis=1).astype(np.float32)
+
+    length = np.linalg.norm(normals, axis=1, keepdims=True)
+    normals /= np.maximum(length, 1e-12)
+
+    return normals
+
+
 class Mesh:
     def __init__(self):
         self.clear()
@@ -31,24 +108,44 @@ class Mesh:
         self.children = []
         self.built = False
 
+        self.use_vbo = True
+        self.vbo = None
+        self.ibo = None
+
+    @property
+    def vertices(self):
+        return self._vertices.view()
+
+    @property
+    def normals(self):
+        return self._normals.view()
+
+    @property
+    def vindices(self):
+        return self._vindices.view()
+
+    @property
+    def nindices(self):
+        return self._nindices.view()
+
     def add_vertex(self, pos):
         assert len(pos) == 3
-        self.vertices.append(pos)
+        self._vertices.append(pos)
 
     def add_normal(self, norm):
         assert len(norm) == 3
-        self.normals.append(norm)
+        self._normals.append(norm)
 
     def add_face(self, face, uv, norm):
         if len(face) == 3:
-            self.vindices.append(face)
+            self._vindices.append(face)
             if len(norm) != 0:
-                self.nindices.append(norm)
+                self._nindices.append(norm)
         else:
             for i in range(1, len(face) - 1):
-                self.vindices.append([face[0], face[i], face[i+1]])
+                self._vindices.append([face[0], face[i], face[i+1]])
                 if len(norm) != 0:
-                    self.nindices.append([norm[0], norm[i], norm[i+1]])
+                    self._nindices.append([norm[0], norm[i], norm[i+1]])
 
         self.n_faces += 1
         if len(face) == 3:
@@ -58,49 +155,100 @@ class Mesh:
         else:
             self.face_n += 1
 
-    def build(self, **kargs):
-        if len(self.vertices) == 0 or len(self.vindices) == 0:
-            return
+    def add_vertices(self, pos):
+        assert pos.ndim == 2 and pos.shape[1] == 3
+        self._vertices.extend(pos)
 
-        varr = []
+    def add_normals(self, norm):
+        assert norm.ndim == 2 and norm.shape[1] == 3
+        self._normals.extend(norm)
 
-        if len(self.nindices) == 0 or ('force_smooth' in kargs and kargs['force_smooth']):
-            normals = [[] for _ in range(len(self.vertices))]
+    def add_faces(self, faces, norms, sizes):
+        # faces, norms: already triangulated (T, 3) index arrays
+        # sizes: vertex count of each original polygon
+        self._vindices.extend(faces)
+        if norms is not None:
+            self._nindices.extend(norms)
 
-            for face in self.vindices:
-                v = np.array([self.vertices[f] for f in face])
-                v1 = v[1] - v[0]
-                v2 = v[2] - v[0]
+        self.n_faces += len(sizes)
+        self.face_3 += int(np.count_nonzero(sizes == 3))
+        self.face_4 += int(np.count_nonzero(sizes == 4))
+        self.face_n += int(np.count_nonzero(sizes > 4))
 
-                normal = np.cross(v1, v2)
-                normal = normal / np.linalg.norm(normal)
+    def build(self, **kargs):
+        if len(self.vertices) == 0 or len(self.vindices) == 0:
+            return
 
-                for f in face:
-                    normals[f].append(normal)
+        if len(self.nindices) != len(self.vindices) or ('force_smooth' in kargs and kargs['force_smooth']):
+            normals = smooth_normals(self.vertices, self.vindices,
+                                     kargs.get('smooth_weight', 'uniform'))
+            nindices = self.vindices
+        else:
+            normals = self.normals
+            nindices = self.nindices
 
-            for i, norms in enumerate(normals):
-                normals[i] = np.sum(np.array(norms), axis=0)
-                normals[i] /= np.linalg.norm(normals[i])
+        # share every distinct (position, normal) pair between the corners using it
+        key = self.vindices.astype(np.int64) * len(normals) + nindices
+        key, iarr = np.unique(key.ravel(), return_inverse=True)
 
-            for face in self.vindices:
-                for i in face:
-                    varr.append(normals[i])
-                    varr.append(self.vertices[i])
-        else:
-            for face in zip(self.vindices, self.nindices):
-                for vi, ni in zip(*face):
-                    varr.append(self.normals[ni])
-                    varr.append(self.vertices[vi])
+        # interleave (normal, position) for every unique vertex
+        self.varr = np.concatenate(
+            (normals[key % len(normals)], self.vertices[key // len(normals)]), axis=-1)
+        self.iarr = iarr.astype(np.uint32)
 
-        self.varr = np.array(varr, dtype=np.float32)
+        # buffers are (re)uploaded lazily on the next render with a GL context
+        if self.vbo is not None:
+            self.vbo.set_array(self.varr)
+            self.ibo.set_array(self.iarr)
 
         self.built = True
 
+    def get_arrays(self):
+        arrays = {
+            'vertices': self.vertices,
+            'normals': self.normals,
+            'vindices': self.vindices,
+            'nindices': self.nindices,
+            'stats': np.array([self.n_faces, self.face_3, self.face_4, self.face_n]),
+        }
+        if self.built:
+            arrays['varr'] = self.varr
+            arrays['iarr'] = self.iarr
+
+        return arrays
+
+    def set_arrays(self, arrays):
+        self._vertices = GrowableArray.wrap(arrays['vertices'])
+        self._normals = GrowableArray.wrap(arrays['normals'])
+        self._vindices = GrowableArray.wrap(arrays['vindices'])
+        self._nindices = GrowableArray.wrap(arrays['nindices'])
+        self.n_faces, self.face_3, self.face_4, self.face_n = map(int, arrays['stats'])
+
+        if 'varr' in arrays:
+            self.varr = arrays['varr']
+            self.iarr = arrays['iarr']
+            if self.vbo is not None:
+                self.vbo.set_array(self.varr)
+                self.ibo.set_array(self.iarr)
+            self.built = True
+
+    def append_arrays(self, arrays):
+        self._vertices.extend(arrays['vertices'])
+        self._normals.extend(arrays['normals'])
+        self._vindices.extend(arrays['vindices'])
+        self._nindices.extend(arrays['nindices'])
+
+        n_faces, face_3, face_4, face_n = map(int, arrays['stats'])
+        self.n_faces += n_faces
+        self.face_3 += face_3
+        self.face_4 += face_4
+        self.face_n += face_n
+
     def clear(self):
-        self.vertices = []
-        self.vindices = []
-        self.nindices = []
-        self.normals = []
+        self._vertices = GrowableArray(3, np.float32)
+        self._vindices = GrowableArray(3, np.int32)
+        self._nindices = GrowableArray(3, np.int32)
+        self._normals = GrowableArray(3, np.float32)
 
         self.n_faces = 0
         self.face_3 = 0
@@ -124,10 +272,27 @@ class Mesh:
             glEnableClientState(GL_VERTEX_ARRAY)
             glEnableClientState(GL_NORMAL_ARRAY)
 
-            glNormalPointer(GL_FLOAT, 6 * self.varr.itemsize, self.varr)
-            glVertexPointer(3, GL_FLOAT, 6 * self.varr.itemsize,
-                            ctypes.c_void_p(self.varr.ctypes.data + 3*self.varr.itemsize))
-            glDrawArrays(GL_TRIANGLES, 0, self.varr.size // 6)
+            stride = 6 * self.varr.itemsize
+
+            if self.use_vbo:
+                if self.vbo is None:
+                    self.vbo = vbo.VBO(self.varr)
+                    self.ibo = vbo.VBO(self.iarr, target=GL_ELEMENT_ARRAY_BUFFER)
+
+                self.vbo.bind()
+                self.ibo.bind()
+
+                glNormalPointer(GL_FLOAT, stride, self.vbo)
+                glVertexPointer(3, GL_FLOAT, stride, self.vbo + 3*self.varr.itemsize)
+                glDrawElements(GL_TRIANGLES, self.iarr.size, GL_UNSIGNED_INT, self.ibo)
+
+                self.ibo.unbind()
+                self.vbo.unbind()
+            else:
+                glNormalPointer(GL_FLOAT, stride, self.varr)
+                glVertexPointer(3, GL_FLOAT, stride,
+                                ctypes.c_void_p(self.varr.ctypes.data + 3*self.varr.itemsize))
+                glDrawElements(GL_TRIANGLES, self.iarr.size, GL_UNSIGNED_INT, self.iarr)
 
             glDisableClientState(GL_NORMAL_ARRAY)
             glDisableClientState(GL_VERTEX_ARRAY)
@@ -138,16 +303,245 @@ class Mesh:
         glPopMatrix()
 
 
+CHUNK_SIZE = 4 << 20
+
+NEWLINE = ord('\n')
+SLASH = ord('/')
+SPACE = ord(' ')
+
+
+def _is_space(c):
+    # space, tab, CR, LF and other control characters
+    return c <= SPACE
+
+
+def _gather_lines(buf, line_starts, selected, indent, skip):
+    # Copy the selected lines (with their trailing newline) into one
+    # contiguous buffer and blank out the leading keyword.
+    lengths = np.diff(line_starts)
+    text = buf[np.repeat(selected, lengths)]
+
+    offsets = np.zeros(np.count_nonzero(selected) + 1, dtype=np.int64)
+    np.cumsum(lengths[selected], out=offsets[1:])
+    for k in range(skip):
+        text[offsets[:-1] + indent[selected] + k] = SPACE
+
+    return text, offsets
+
+
+def _count_per_line(mask, offsets):
+    pos = np.flatnonzero(mask)
+    return np.diff(np.searchsorted(pos, offsets))
+
+
+def _count_tokens(text, offsets):
+    space = _is_space(text)
+    tok_start = ~space
+    tok_start[1:] &= space[:-1]
+    return _count_per_line(tok_start, offsets)
+
+
+def _parse_numbers(text, counts, dtype):
+    # Parse every number of the buffer with a single C-level call and
+    # return it with the index of the first number of each line.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        values = np.fromstring(text.tobytes(), dtype=dtype, sep=' ')
+
+    if len(values) != counts.sum():
+        raise ValueError('malformed number in OBJ records')
+
+    first = np.zeros(len(counts), dtype=np.int64)
+    np.cumsum(counts[:-1], out=first[1:])
+
+    return values, first
+
+
+def _resolve_index(idx, base):
+    # OBJ indices are 1-based; negative ones are relative to the element
+    # count at the point where the face is declared.
+    return np.where(idx < 0, idx + base, idx - 1)
+
+
+def _parse_face_line(line, vbase, nbase):
+    face = []
+    norm = []
+
+    for arg in line.split()[1:]:
+        fun = arg.split('/')
+
+        face.append(int(fun[0]))
+        if len(fun) >= 3 and len(fun[2]) > 0:
+            norm.append(int(fun[2]))
+
+    face = _resolve_index(np.array(face), vbase)
+    norm = _resolve_index(np.array(norm), nbase) if len(norm) == len(face) else None
+
+    return face, norm
+
+
+def _split_records(obj):
+    if isinstance(obj, str):
+        obj = obj.encode()
+    if not obj.endswith(b'\n'):
+        obj += b'\n'
+
+    buf = np.frombuffer(obj, dtype=np.uint8)
+
+    # split into lines and skip leading whitespace
+    ends = np.flatnonzero(buf == NEWLINE)
+    line_starts = np.zeros(len(ends) + 1, dtype=np.int64)
+    line_starts[1:] = ends + 1
+    starts = line_starts[:-1].copy()
+
+    while True:
+        indent = _is_space(buf[starts]) & (starts < ends)
+        if not indent.any():
+            break
+        starts[indent] += 1
+
+    # classify every line by its keyword
+    c0 = buf[starts]
+    c1 = buf[np.minimum(starts + 1, ends)]
+    c2 = buf[np.minimum(starts + 2, ends)]
+
+    is_v = (c0 == ord('v')) & _is_space(c1)
+    is_vn = (c0 == ord('v')) & (c1 == ord('n')) & _is_space(c2)
+    is_f = (c0 == ord('f')) & _is_space(c1)
+
+    indent = starts - line_starts[:-1]
+
+    return obj, buf, line_starts, indent, is_v, is_vn, is_f
+
+
+def _read_chunks(f, size, chunk_size):
+    # yield newline terminated pieces of the next size bytes of f along with
+    # the number of bytes consumed so far; records straddling a piece
+    # boundary are carried over to the next one
+    done = 0
+    rest = b''
+
+    while done < size:
+        data = f.read(min(chunk_size, size - done))
+        if not data:
+            break
+        done += len(data)
+
+        data = rest + data
+        cut = data.rfind(b'\n') + 1
+        rest = data[cut:]
+
+        if cut > 0:
+            yield data[:cut], done
+
+    if rest:
+        yield rest, done
+
+
+def _find_ranges(filename, n):
+    # split the file into n byte ranges starting at line boundaries
+    size = os.path.getsize(filename)
+    bounds = [0]
+
+    with open(filename, 'rb') as f:
+        for i in range(1, n):
+            pos = max(size * i // n, bounds[-1])
+            if pos > 0:
+                f.seek(pos - 1)
+                f.readline()
+                pos = f.tell()
+            bounds.append(min(pos, size))
+
+    bounds.append(size)
+
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def _count_range(filename, start, end):
+    counts = np.zeros(2, dtype=np.int64)
+
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        for data, _ in _read_chunks(f, end - start, CHUNK_SIZE):
+            _, _, _, _, is_v, is_vn, _ = _split_records(data)
+            counts += np.count_nonzero(is_v), np.count_nonzero(is_vn)
+
+    return counts
+
+
+def _parse_range(filename, start, end, vcount, ncount):
+    mesh = Mesh()
+    counts = (vcount, ncount)
+
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        for data, _ in _read_chunks(f, end - start, CHUNK_SIZE):
+            counts = ObjMeshLoader.load_chunk(data, mesh, *counts)
+
+    # hand the arrays back through shared memory instead of pickling them;
+    # the parent process unlinks the blocks once it copied them
+    desc = {}
+    for name, arr in mesh.get_arrays().items():
+        if arr.nbytes == 0:
+            desc[name] = (None, arr.shape, arr.dtype.str)
+            continue
+
+        shm = shared_memory.SharedMemory(create=True, size=arr.nbytes)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        desc[name] = (shm.name, arr.shape, arr.dtype.str)
+        shm.close()
+
+        # the block is owned (and unlinked) by the parent from now on
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+    return desc
+
+
+def _append_shared(mesh, desc):
+    blocks = [shared_memory.SharedMemory(name=shm_name)
+              for shm_name, _, _ in desc.values() if shm_name is not None]
+
+    try:
+        if mesh is not None:
+            arrays = {}
+            it = iter(blocks)
+            for name, (shm_name, shape, dtype) in desc.items():
+                buf = next(it).buf if shm_name is not None else None
+                arrays[name] = np.ndarray(shape, dtype=dtype, buffer=buf)
+
+            mesh.append_arrays(arrays)
+            del arrays
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
 class ObjMeshLoader:
     @staticmethod
     def from_file(filename, **kargs):
-        with open(filename, 'rt') as f:
-            return ObjMeshLoader.load(f.read(), **kargs)
+        mesh = Mesh()
+
+        ObjMeshLoader.from_file_noret(filename, mesh, **kargs)
+
+        return mesh
 
     @staticmethod
-    def from_file_noret(filename, mesh, **kargs):
-        with open(filename, 'rt') as f:
-            ObjMeshLoader.load_noret(f.read(), mesh, **kargs)
+    def from_file_noret(filename, mesh, cache=True, progress=None, workers=1, **kargs):
+        if cache:
+            arrays = meshcache.lookup(filename, kargs)
+            if arrays is not None:
+                mesh.set_arrays(arrays)
+                return
+
+        if workers > 1:
+            ObjMeshLoader.load_parallel(filename, mesh, workers, progress=progress, **kargs)
+        else:
+            with open(filename, 'rb') as f:
+                ObjMeshLoader.load_stream(f, mesh, progress=progress, **kargs)
+
+        if cache:
+            meshcache.store(filename, kargs, mesh.get_arrays())
 
     @staticmethod
     def load(obj, **kargs):
@@ -159,35 +553,151 @@ class ObjMeshLoader:
 
     @staticmethod
     def load_noret(obj, mesh, **kargs):
-        for line in obj.split('\n'):
-            line = line.strip()
+        ObjMeshLoader.load_chunk(obj, mesh)
 
-            # ignore empty or commented line
-            if len(line) == 0 or line[0] == '#':
-                continue
+        mesh.build(**kargs)
 
-            cmd, *args = line.split()
+    @staticmethod
+    def load_stream(f, mesh, chunk_size=CHUNK_SIZE, progress=None, **kargs):
+        # progress(bytes_read, total_bytes) is called after every chunk
+        total = os.fstat(f.fileno()).st_size - f.tell()
+        counts = (0, 0)
 
-            if cmd == 'v':  # vertex
-                mesh.add_vertex(list(map(float, args)))
-            elif cmd == 'vn':  # normal
-                mesh.add_normal(list(map(float, args)))
-            elif cmd == 'f':  # face
-                face = []
-                uv = []
-                norm = []
+        for data, done in _read_chunks(f, total, chunk_size):
+            counts = ObjMeshLoader.load_chunk(data, mesh, *counts)
 
-                for arg in args:
-                    fun = arg.split('/')
+            if progress is not None:
+                progress(done, total)
 
-                    if len(fun) >= 1:
-                        face.append(int(fun[0]) - 1)
-                    if len(fun) >= 3:
-                        uv.append(int(fun[1]) - 1 if len(fun[1]) > 0 else 0)
-                        norm.append(int(fun[2]) - 1 if len(fun[2]) > 0 else 0)
-                    if len(fun) == 2:
-                        norm.append(int(fun[1]) - 1 if len(fun[1]) > 0 else 0)
+        mesh.build(**kargs)
 
-                mesh.add_face(face, uv, norm)
+    @staticmethod
+    def load_parallel(filename, mesh, workers, progress=None, **kargs):
+        ranges = _find_ranges(filename, workers)
+        size = os.path.getsize(filename)
+
+        if len(ranges) <= 1:
+            with open(filename, 'rb') as f:
+                return ObjMeshLoader.load_stream(f, mesh, progress=progress, **kargs)
+
+        with ProcessPoolExecutor(workers) as pool:
+            # first pass: count vertices & normals of every range so each
+            # worker knows the global offset for relative face indices
+            counts = list(pool.map(_count_range, *zip(*[(filename, a, b) for a, b in ranges])))
+            bases = np.cumsum([np.zeros(2, dtype=np.int64)] + counts[:-1], axis=0)
+
+            futures = [pool.submit(_parse_range, filename, a, b, int(vbase), int(nbase))
+                       for (a, b), (vbase, nbase) in zip(ranges, bases)]
+
+            # stitch the results in file order
+            consumed = 0
+            try:
+                for (_, end), future in zip(ranges, futures):
+                    consumed += 1
+                    _append_shared(mesh, future.result())
+
+                    if progress is not None:
+                        progress(end, size)
+            finally:
+                # release the shared blocks of results that were not used
+                for future in futures[consumed:]:
+                    if not future.cancel() and future.exception() is None:
+                        _append_shared(None, future.result())
 
         mesh.build(**kargs)
+
+    @staticmethod
+    def load_chunk(obj, mesh, vcount=0, ncount=0):
+        # vcount, ncount: vertices & normals declared by the preceding chunks,
+        # needed to resolve relative face indices
+        obj, buf, line_starts, indent, is_v, is_vn, is_f = _split_records(obj)
+
+        # vertices & normals
+        for mask, skip, add in ((is_v, 1, mesh.add_vertices), (is_vn, 2, mesh.add_normals)):
+            if not mask.any():
+                continue
+
+            text, offsets = _gather_lines(buf, line_starts, mask, indent, skip)
+            counts = _count_tokens(text, offsets)
+            values, first = _parse_numbers(text, counts, np.float32)
+            if counts.min() < 3:
+                raise ValueError('vertex record with less than 3 components')
+
+            add(values[first[:, None] + np.arange(3)])
+
+        # faces
+        if is_f.any():
+            vbase = vcount + np.cumsum(is_v)[is_f]
+            nbase = ncount + np.cumsum(is_vn)[is_f]
+            f_starts = line_starts[:-1][is_f]
+
+            text, offsets = _gather_lines(buf, line_starts, is_f, indent, 1)
+            sizes = _count_tokens(text, offsets)
+            slashes = _count_per_line(text == SLASH, offsets)
+            doubles = np.zeros_like(slashes)
+            if slashes.any():
+                is_slash = text == SLASH
+                doubles = _count_per_line(is_slash[:-1] & is_slash[1:], offsets)
+                text[is_slash] = SPACE
+
+            # every '/' splits a corner into one more number, '//' into none
+            counts = sizes + slashes - doubles
+            values, first = _parse_numbers(text, counts, np.int64)
+
+            # fields per corner: v, v/t, v/t/n or v//n
+            fields = np.zeros_like(sizes)
+            fields[slashes == 0] = 1
+            fields[(slashes == sizes) & (doubles == 0)] = 2
+            fields[(slashes == 2 * sizes) & (doubles == 0)] = 3
+            fields[(slashes == 2 * sizes) & (doubles == sizes)] = 2
+            normal_col = np.where(doubles > 0, 1, np.where(fields == 3, 2, -1))
+
+            regular = (fields > 0) & (counts == sizes * fields)
+
+            tri_first = np.zeros(len(sizes) + 1, dtype=np.int64)
+            np.cumsum(np.maximum(sizes - 2, 0), out=tri_first[1:])
+
+            vindices = np.empty((tri_first[-1], 3), dtype=np.int64)
+            nindices = np.empty((tri_first[-1], 3), dtype=np.int64)
+            has_normal = True
+
+            # bulk path: every group of faces sharing the same layout is
+            # sliced out of the parsed numbers and fan-triangulated at once
+            key = np.where(regular, sizes * 8 + fields * 2 + (normal_col > 0), -1)
+            for k in np.unique(key[regular & (sizes >= 3)]):
+                rows = np.flatnonzero(key == k)
+                size, n_fields, ncol = sizes[rows[0]], fields[rows[0]], normal_col[rows[0]]
+
+                corners = values[first[rows, None] + np.arange(size * n_fields)]
+                corners = corners.reshape(len(rows), size, n_fields)
+
+                fan = np.stack([np.zeros(size - 2, dtype=np.int64),
+                                np.arange(1, size - 1),
+                                np.arange(2, size)], axis=1)
+                dst = tri_first[rows, None] + np.arange(size - 2)
+
+                vi = _resolve_index(corners[:, :, 0], vbase[rows, None])
+                vindices[dst] = vi[:, fan]
+
+                if ncol > 0:
+                    ni = _resolve_index(corners[:, :, ncol], nbase[rows, None])
+                    nindices[dst] = ni[:, fan]
+                else:
+                    has_normal = False
+
+            # fallback path for faces mixing corner layouts
+            for row in np.flatnonzero(~regular & (sizes >= 3)):
+                line = obj[f_starts[row]:f_starts[row] + offsets[row + 1] - offsets[row]]
+                face, norm = _parse_face_line(line.decode(), vbase[row], nbase[row])
+
+                for i in range(1, len(face) - 1):
+                    vindices[tri_first[row] + i - 1] = face[[0, i, i+1]]
+                    if norm is not None:
+                        nindices[tri_first[row] + i - 1] = norm[[0, i, i+1]]
+                    else:
+                        has_normal = False
+
+            valid = sizes >= 3
+            mesh.add_faces(vindices, nindices if has_normal else None, sizes[valid])
+
+        return vcount + np.count_nonzero(is_v), ncount + np.count_nonzero(is_vn)
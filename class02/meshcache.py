@@ -0,0 +1,95 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+CACHE_DIR_NAME = '.objcache'
+CACHE_LIMIT = 2 << 30  # bytes per cache directory
+
+
+def cache_dir(filename):
+    return os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIR_NAME)
+
+
+def cache_key(filename, options):
+    st = os.stat(filename)
+
+    key = '|'.join([os.path.abspath(filename), str(st.st_size), str(st.st_mtime_ns)] +
+                   ['%s=%r' % item for item in sorted(options.items())])
+
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def lookup(filename, options):
+    entry = os.path.join(cache_dir(filename), cache_key(filename, options))
+    if not os.path.isdir(entry):
+        return None
+
+    try:
+        arrays = {name[:-4]: np.load(os.path.join(entry, name), mmap_mode='r')
+                  for name in os.listdir(entry) if name.endswith('.npy')}
+    except (OSError, ValueError):
+        return None
+
+    # mark as recently used for the LRU eviction
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+
+    return arrays
+
+
+def store(filename, options, arrays):
+    root = cache_dir(filename)
+    entry = os.path.join(root, cache_key(filename, options))
+
+    try:
+        os.makedirs(root, exist_ok=True)
+
+        # write into a temporary directory first so readers never see a
+        # partially written entry
+        tmp = tempfile.mkdtemp(dir=root, prefix='.tmp-')
+    except OSError:
+        # caching is best effort, e.g. read-only model directories
+        return
+
+    try:
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(arr))
+
+        if os.path.isdir(entry):
+            shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+
+    evict(root, keep=entry)
+
+
+def entry_size(entry):
+    return sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+
+
+def evict(root, limit=None, keep=None):
+    if limit is None:
+        limit = CACHE_LIMIT
+
+    entries = [os.path.join(root, name) for name in os.listdir(root)
+               if not name.startswith('.')]
+    entries = [(os.path.getmtime(e), entry_size(e), e) for e in entries if os.path.isdir(e)]
+
+    total = sum(size for _, size, _ in entries)
+
+    # drop least recently used entries until the directory fits the limit
+    for _, size, entry in sorted(entries):
+        if total <= limit:
+            break
+        if entry == keep:
+            continue
+
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
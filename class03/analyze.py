@@ -0,0 +1,187 @@
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# no OpenGL / GLFW imports here, this runs on headless machines
+from bvh import parse_bvh
+from kinematics import channel_groups, euler_to_quaternions, local_translations
+
+PERCENTILES = (50, 95, 99)
+
+# frame-to-frame rotation change of a joint (degrees) counted as a jump
+MAX_ANGLE_STEP = 45.
+
+# root steps this many times longer than the median step are jumps
+MAX_ROOT_STEP_RATIO = 10.
+
+# frame indices listed per kind of discontinuity
+MAX_REPORTED_FRAMES = 20
+
+
+def find_files(paths):
+    files = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                files.extend(os.path.join(root, name) for name in sorted(names)
+                             if name.lower().endswith('.bvh'))
+        else:
+            files.append(path)
+
+    return files
+
+
+def rotation_steps(bvh):
+    # (frames - 1, J) rotation change of every joint between consecutive
+    # frames in degrees, NaN for joints without rotation channels
+    steps = np.full((max(bvh.num_of_frames - 1, 0), len(bvh.skeleton)), np.nan)
+
+    for order, (joints, columns) in channel_groups(bvh.skeleton).items():
+        q = euler_to_quaternions(bvh.motion[:, columns], order)
+        dot = np.abs(np.einsum('fjc,fjc->fj', q[1:], q[:-1]))
+
+        steps[:, joints] = 2 * np.degrees(np.arccos(np.minimum(dot, 1.)))
+
+    return steps
+
+
+def analyze_file(filename, max_angle_step=MAX_ANGLE_STEP):
+    try:
+        with open(filename, 'rt') as f:
+            bvh = parse_bvh(f.readlines())
+    except Exception as e:
+        return {'file': filename, 'error': '%s: %s' % (type(e).__name__, e)}
+
+    if len(bvh.joints) == 0:
+        return {'file': filename, 'error': 'no HIERARCHY found'}
+
+    motion = bvh.motion
+    skeleton = bvh.skeleton
+
+    stats = {
+        'file': filename,
+        'frames': bvh.num_of_frames,
+        'fps': bvh.fps,
+        'joints': bvh.joints,
+    }
+
+    nan_frames, nan_channels = np.nonzero(np.isnan(motion))
+    stats['nan_values'] = len(nan_frames)
+    stats['nan_frames'] = np.unique(nan_frames)[:MAX_REPORTED_FRAMES].tolist()
+
+    # distance travelled by the root
+    root = local_translations(skeleton, motion)[:, 0]
+    root_steps = np.linalg.norm(np.diff(root, axis=0), axis=-1)
+    stats['root_path_length'] = float(np.nansum(root_steps))
+
+    # angular velocity of every joint with rotation channels, in deg/s
+    steps = rotation_steps(bvh)
+    angular = {}
+    for j, name in enumerate(skeleton.names):
+        if skeleton.is_end[j] or len(steps) == 0 or np.isnan(steps[:, j]).all():
+            continue
+
+        p = np.nanpercentile(steps[:, j] * bvh.fps, PERCENTILES)
+        angular[name] = dict({'p%d' % q: float(v) for q, v in zip(PERCENTILES, p)},
+                             max=float(np.nanmax(steps[:, j]) * bvh.fps))
+    stats['angular_velocity'] = angular
+
+    # frame i is a jump when it differs too much from frame i - 1
+    rotation_jumps = np.flatnonzero((steps > max_angle_step).any(axis=1)) + 1
+
+    median = np.nanmedian(root_steps) if len(root_steps) > 0 else 0.
+    if median > 0:
+        root_jumps = np.flatnonzero(root_steps > MAX_ROOT_STEP_RATIO * median) + 1
+    else:
+        root_jumps = np.zeros(0, dtype=np.int64)
+
+    stats['rotation_jumps'] = len(rotation_jumps)
+    stats['rotation_jump_frames'] = rotation_jumps[:MAX_REPORTED_FRAMES].tolist()
+    stats['root_jumps'] = len(root_jumps)
+    stats['root_jump_frames'] = root_jumps[:MAX_REPORTED_FRAMES].tolist()
+
+    return stats
+
+
+def write_json(results, f):
+    json.dump(results, f, indent=2)
+    f.write('\n')
+
+
+def output_format(fmt, output):
+    # the --format given, else csv for a .csv --output and json otherwise
+    if fmt is None:
+        fmt = 'csv' if output is not None and output.lower().endswith('.csv') else 'json'
+
+    return fmt
+
+
+def write_output(results, output, fmt, write_csv):
+    # results as json, or csv with write_csv, to the output file or stdout
+    out = sys.stdout if output is None else open(output, 'wt', newline='')
+    try:
+        (write_csv if fmt == 'csv' else write_json)(results, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def write_csv(results, f):
+    # one row per file and joint
+    writer = csv.writer(f)
+    writer.writerow(['file', 'error', 'frames', 'fps', 'num_of_joints', 'root_path_length',
+                     'nan_values', 'rotation_jumps', 'root_jumps', 'joint'] +
+                    ['angular_velocity_p%d' % q for q in PERCENTILES] + ['angular_velocity_max'])
+
+    for stats in results:
+        if 'error' in stats:
+            writer.writerow([stats['file'], stats['error']])
+            continue
+
+        common = [stats['file'], '', stats['frames'], stats['fps'], len(stats['joints']),
+                  stats['root_path_length'], stats['nan_values'],
+                  stats['rotation_jumps'], stats['root_jumps']]
+
+        for joint, v in stats['angular_velocity'].items():
+            writer.writerow(common + [joint] + [v['p%d' % q] for q in PERCENTILES] + [v['max']])
+        if len(stats['angular_velocity']) == 0:
+            writer.writerow(common)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-file statistics of BVH motion files.')
+    parser.add_argument('paths', nargs='+', help='BVH files or directories searched recursively')
+    parser.add_argument('-o', '--output', help='output file, stdout by default')
+    parser.add_argument('-f', '--format', choices=['json', 'csv'],
+                        help='output format, guessed from --output and json by default')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--max-angle-step', type=float, default=MAX_ANGLE_STEP,
+                        help='rotation change per frame in degrees reported as a jump')
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+
+    fmt = output_format(args.format, args.output)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        # small chunks keep every worker busy when file sizes vary a lot
+        stats = executor.map(analyze_file, files, [args.max_angle_step] * len(files), chunksize=4)
+
+        for i, s in enumerate(stats, 1):
+            results.append(s)
+            print('[%d/%d] %s' % (i, len(files), s['file']), file=sys.stderr)
+
+    write_output(results, args.output, fmt, write_csv)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,484 @@
+from enum import Enum
+import numpy as np
+import os
+import threading
+
+import bvhcache
+from kinematics import forward_kinematics, motion_or_rest_pose
+
+# bytes of motion text parsed per step of a BVHStream
+STREAM_CHUNK_SIZE = 1 << 20
+
+# motion rows formatted per step of write_bvh
+WRITE_BLOCK = 1 << 14
+
+class BVHParserState(Enum):
+    NONE = 0,
+    HIERARCHY = 1,
+    MOTION = 2
+
+class BVHNode:
+    def __init__(self, name, parent=None, is_end=False):
+        self.name = name
+        self.parent = parent
+        self.is_end = is_end
+
+        # position in BVH.nodes and first column in BVH.motion
+        self.index = 0
+        self.channel_index = 0
+
+        self.offset = np.zeros(3)
+        self.channels = []
+        self.frames = []
+
+        self.children = []
+
+class Skeleton:
+    # flat, array based view of the node tree; joint i is BVH.nodes[i]
+    def __init__(self, nodes):
+        self.names = [node.name for node in nodes]
+        self.channels = [node.channels for node in nodes]
+
+        self.parents = np.array([-1 if node.parent is None else node.parent.index
+                                 for node in nodes], dtype=np.int64)
+        self.offsets = np.array([node.offset for node in nodes], dtype=float).reshape(-1, 3)
+        self.is_end = np.array([node.is_end for node in nodes], dtype=bool)
+
+        # motion columns [channel_index, channel_index + channel_count)
+        self.channel_index = np.array([node.channel_index for node in nodes], dtype=np.int64)
+        self.channel_count = np.array([len(node.channels) for node in nodes], dtype=np.int64)
+        self.num_of_channels = int(self.channel_count.sum())
+
+        # joints grouped by depth; every level only depends on the previous one
+        depth = np.zeros(len(nodes), dtype=np.int64)
+        for i in range(1, len(nodes)):
+            depth[i] = depth[self.parents[i]] + 1
+        self.depth = depth
+        self.levels = [np.flatnonzero(depth == d) for d in range(depth.max() + 1)]
+
+    def __len__(self):
+        return len(self.names)
+
+
+class BVH:
+    def __init__(self):
+        self.root = BVHNode('ROOT')
+
+        self.joints = []
+        self.num_of_frames = 0
+        self.fps = 0
+
+        # every node (end sites included), parents before children
+        self.nodes = [self.root]
+        self.skeleton = None
+
+        # (num_of_frames, total number of channels)
+        self.motion = np.zeros((0, 0))
+
+        self._global_transforms = None
+
+    def set_motion(self, motion):
+        self.motion = motion
+        self.num_of_frames = len(motion)
+        self._global_transforms = None
+
+        # every node gets a zero-copy column slice of the motion matrix
+        for node in self.nodes:
+            if len(node.channels) > 0:
+                node.frames = motion[:, node.channel_index:node.channel_index+len(node.channels)]
+
+    def header(self):
+        # hierarchy metadata, enough to rebuild the BVH without its motion
+        return {
+            'fps': self.fps,
+            'joints': self.joints,
+            'nodes': [{
+                'name': node.name,
+                'parent': -1 if node.parent is None else node.parent.index,
+                'is_end': node.is_end,
+                'offset': node.offset.tolist(),
+                'channels': node.channels,
+                'channel_index': node.channel_index,
+            } for node in self.nodes]
+        }
+
+    @staticmethod
+    def from_header(header, motion):
+        bvh = BVH()
+        bvh.fps = header['fps']
+        bvh.joints = list(header['joints'])
+        bvh.nodes = []
+
+        for i, desc in enumerate(header['nodes']):
+            parent = bvh.nodes[desc['parent']] if desc['parent'] >= 0 else None
+
+            node = BVHNode(desc['name'], parent, desc['is_end'])
+            node.index = i
+            node.offset = np.array(desc['offset'], dtype=float)
+            node.channels = list(desc['channels'])
+            node.channel_index = desc['channel_index']
+
+            if parent is not None:
+                parent.children.append(node)
+            bvh.nodes.append(node)
+
+        bvh.root = bvh.nodes[0]
+        bvh.skeleton = Skeleton(bvh.nodes)
+        bvh.set_motion(motion)
+
+        return bvh
+
+    def global_transforms(self):
+        # (num_of_frames, num_of_nodes, 4, 4), computed once and cached
+        if self._global_transforms is None:
+            self._global_transforms = forward_kinematics(self.skeleton, motion_or_rest_pose(self))
+
+        return self._global_transforms
+
+    def __repr__(self):
+        def _make_str(level, msg):
+            return '  ' * level + msg + os.linesep
+
+        result = ''
+
+        node_stack = [(self.root, 0)]
+
+        while node_stack:
+            node, level = node_stack[-1]
+            node_stack.pop()
+
+            result += _make_str(level, '<{}>'.format(node.name))
+            result += _make_str(level, 'offset: ' + str(node.offset))
+            result += _make_str(level, 'channel: ' + ', '.join(node.channels))
+            result += _make_str(level, 'is endpoint: {}'.format(node.is_end))
+
+            if not node.is_end:
+                result += _make_str(level, 'first frame: ' + str(node.frames[0]))
+                result += _make_str(level, 'last frame: ' + str(node.frames[-1]))
+
+                for c in node.children:
+                    node_stack.append((c, level+1))
+
+        return result
+
+
+def parse_header(lines):
+    # parse HIERARCHY up to and including "Frame Time:", leaving the motion
+    # rows in lines (an iterator) -> (bvh, number of channels per frame)
+    state = BVHParserState.NONE
+
+    bvh = BVH()
+    cur_node = None
+    node_stack = [bvh.root]
+
+    tot_num_of_channels = 0
+
+    for line in lines:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        key, *args = line.split()
+        key = key.upper()
+
+        if key == 'HIERARCHY':
+            state = BVHParserState.HIERARCHY
+            continue
+        elif key == 'MOTION':
+            state = BVHParserState.MOTION
+            continue
+
+        if state == BVHParserState.HIERARCHY:
+            if key == 'JOINT' or key == 'ROOT':
+                bvh.joints.append(args[0])
+
+            if key == '{':
+                node_stack.append(cur_node)
+            elif key == '}':
+                node_stack.pop()
+            elif key == 'ROOT':
+                cur_node = bvh.root
+                cur_node.name = args[0]
+            elif key == 'JOINT':
+                cur_node = BVHNode(args[0], node_stack[-1], False)
+                cur_node.index = len(bvh.nodes)
+                node_stack[-1].children.append(cur_node)
+                bvh.nodes.append(cur_node)
+            elif key == 'END':
+                cur_node = BVHNode(args[0], node_stack[-1], True)
+                cur_node.index = len(bvh.nodes)
+                node_stack[-1].children.append(cur_node)
+                bvh.nodes.append(cur_node)
+            elif key == 'OFFSET':
+                cur_node.offset = np.fromiter(map(float, args), dtype=float)
+            elif key == 'CHANNELS':
+                cur_node.channels.extend(list(map(lambda x: x.upper(), args[1:])))
+                cur_node.channel_index = tot_num_of_channels
+                tot_num_of_channels += int(args[0])
+
+        elif state == BVHParserState.MOTION:
+            if line.upper().startswith('FRAMES:'):
+                bvh.num_of_frames = int(args[-1])
+            elif line.upper().startswith('FRAME TIME:'):
+                bvh.fps = 1 / float(args[-1])
+                break
+
+    bvh.skeleton = Skeleton(bvh.nodes)
+
+    return bvh, tot_num_of_channels
+
+
+def parse_bvh(lines):
+    lines = iter(lines)
+    bvh, num_of_channels = parse_header(lines)
+
+    # the rest of the file is the motion matrix
+    bvh.set_motion(parse_motion(list(lines), num_of_channels, bvh.num_of_frames))
+
+    return bvh
+
+
+def load_bvh(filename, cache=True):
+    # parse filename, or memory-map its motion from the binary cache
+    if cache:
+        entry = bvhcache.lookup(filename)
+        if entry is not None:
+            return BVH.from_header(*entry)
+
+    with open(filename, 'rt') as f:
+        bvh = parse_bvh(f.readlines())
+
+    if cache:
+        bvhcache.store(filename, bvh.header(), bvh.motion)
+
+    return bvh
+
+
+# ASCII of '0000' ... '9999', then '   0' ... '9999' and '    ', four bytes
+# packed in one uint32 per entry
+DIGIT_GROUPS = np.array([b'%04d' % i for i in range(10000)] +
+                        [b'%4d' % i for i in range(10000)] + [b'    ']).view(np.uint32)
+BLANK_GROUP = 20000
+
+
+def format_motion(motion, precision=6):
+    # (frames, channels) -> bytes, one line per frame. Every value is
+    # right-aligned in a fixed-width field and the digits of all values are
+    # looked up four at a time instead of formatting values one by one.
+    num_of_frames, num_of_channels = motion.shape
+    if motion.size == 0:
+        return b'\n' * num_of_frames
+
+    scaled = np.round(np.abs(motion) * 10**precision).astype(np.int64)
+    integer, fraction = np.divmod(scaled, 10**precision)
+
+    # groups of four digits: integer part without leading zeros, padded
+    # with blanks to the widest value; fraction zero padded
+    int_digits = len(str(int(integer.max())))
+    int_groups = -(-int_digits // 4)
+    frac_groups = -(-precision // 4)
+
+    groups = np.empty((num_of_frames, num_of_channels, int_groups + frac_groups), dtype=np.uint32)
+
+    v = integer
+    for g in range(int_groups - 1, -1, -1):
+        v, group = np.divmod(v, 10000)
+        index = np.where(v > 0, group, group + 10000)
+        if g < int_groups - 1:
+            index[(v == 0) & (group == 0)] = BLANK_GROUP
+        groups[..., g] = DIGIT_GROUPS[index]
+
+    # fraction digits left-aligned in their groups
+    v = fraction * 10**(frac_groups * 4 - precision)
+    for g in range(int_groups + frac_groups - 1, int_groups - 1, -1):
+        v, group = np.divmod(v, 10000)
+        groups[..., g] = DIGIT_GROUPS[group]
+
+    # sign, integer part, '.', fraction and a separator per field
+    width = 1 + int_digits + (precision + 1 if precision > 0 else 0)
+
+    chars = np.empty((num_of_frames, num_of_channels, width + 1), dtype=np.uint8)
+    digits = groups.view(np.uint8)
+    int_end = int_groups * 4
+
+    chars[..., 0] = ord(' ')
+    chars[..., 1:1 + int_digits] = digits[..., int_end - int_digits:int_end]
+    if precision > 0:
+        chars[..., 1 + int_digits] = ord('.')
+        chars[..., 2 + int_digits:width] = digits[..., int_end:int_end + precision]
+
+    chars[..., width] = ord(' ')
+    chars[:, -1, width] = ord('\n')
+
+    # minus sign right before the first digit, none for values rounding to 0
+    neg = np.flatnonzero((motion < 0) & (scaled > 0))
+    first = np.searchsorted(10**np.arange(1, 19, dtype=np.int64), integer.ravel()[neg], side='right') + 1
+    chars.reshape(-1)[neg * (width + 1) + int_digits - first] = ord('-')
+
+    return chars.tobytes()
+
+
+def write_bvh(bvh, filename, precision=6):
+    lines = ['HIERARCHY']
+
+    def _write_node(node, level):
+        indent = '  ' * level
+
+        if node.is_end:
+            lines.append(indent + 'End Site')
+        elif node.parent is None:
+            lines.append(indent + 'ROOT ' + node.name)
+        else:
+            lines.append(indent + 'JOINT ' + node.name)
+
+        lines.append(indent + '{')
+        # offsets round-trip exactly, precision only applies to the motion
+        lines.append(indent + '  OFFSET ' + ' '.join(repr(float(x)) for x in node.offset))
+        if len(node.channels) > 0:
+            lines.append(indent + '  CHANNELS %d %s ' % (len(node.channels), ' '.join(node.channels)))
+
+        for c in node.children:
+            _write_node(c, level + 1)
+
+        lines.append(indent + '}')
+
+    _write_node(bvh.root, 0)
+
+    lines.append('MOTION')
+    lines.append('Frames: %d' % bvh.num_of_frames)
+    lines.append('Frame Time: %.9g' % (1 / bvh.fps))
+
+    with open(filename, 'wb') as f:
+        f.write(('\n'.join(lines) + '\n').encode())
+
+        for start in range(0, bvh.num_of_frames, WRITE_BLOCK):
+            f.write(format_motion(bvh.motion[start:start + WRITE_BLOCK], precision))
+
+
+def check_motion_size(num_of_values, num_of_frames, num_of_channels):
+    # a missing or extra value would shift every later frame
+    if num_of_values != num_of_frames * num_of_channels:
+        raise ValueError('expected %d frames of %d channels (%d values), found %d values' % (
+            num_of_frames, num_of_channels, num_of_frames * num_of_channels, num_of_values))
+
+
+def parse_motion(lines, num_of_channels, num_of_frames=None):
+    motion = np.fromstring(' '.join(lines), dtype=float, sep=' ')
+
+    if num_of_frames is None:
+        num_of_frames = len(motion) // max(num_of_channels, 1)
+        motion = motion[:num_of_frames * num_of_channels]
+    else:
+        check_motion_size(len(motion), num_of_frames, num_of_channels)
+
+    return motion.reshape(num_of_frames, num_of_channels)
+
+
+class FrameBuffer:
+    # (frames, channels) motion matrix that doubles its capacity when full
+    def __init__(self, num_of_channels, capacity=256):
+        self.data = np.empty((max(capacity, 1), num_of_channels))
+        self.size = 0
+
+    def extend(self, frames):
+        size = self.size + len(frames)
+
+        if size > len(self.data):
+            data = np.empty((max(size, 2 * len(self.data)), self.data.shape[1]))
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+        self.data[self.size:size] = frames
+        self.size = size
+
+    def view(self):
+        return self.data[:self.size]
+
+    def __len__(self):
+        return self.size
+
+
+class BVHStream:
+    # Parses the hierarchy right away and reads the motion on a background
+    # thread, so playback can start with the first chunk of frames.
+    # motion() is the part read so far; a cached file is complete at once.
+    def __init__(self, filename, chunk_size=STREAM_CHUNK_SIZE, cache=True):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.cache = cache
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.error = None
+
+        entry = bvhcache.lookup(filename) if cache else None
+        if entry is not None:
+            self.bvh = BVH.from_header(*entry)
+            self.num_of_frames = self.bvh.num_of_frames
+            self.buffer = None
+            self.done = True
+            return
+
+        self.file = open(filename, 'rt')
+        try:
+            self.bvh, self.num_of_channels = parse_header(self.file)
+        except Exception:
+            self.file.close()
+            raise
+
+        # number of frames announced by the file
+        self.num_of_frames = self.bvh.num_of_frames
+        self.bvh.set_motion(np.zeros((0, self.num_of_channels)))
+
+        self.buffer = FrameBuffer(self.num_of_channels, self.num_of_frames)
+        self.done = False
+
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def available(self):
+        # number of frames read so far
+        if self.buffer is None:
+            return self.bvh.num_of_frames
+
+        with self.lock:
+            return len(self.buffer)
+
+    def motion(self):
+        if self.buffer is None:
+            return self.bvh.motion
+
+        with self.lock:
+            return self.buffer.view()
+
+    def close(self):
+        self.stopped.set()
+
+    def _read(self):
+        rest = np.zeros(0)
+
+        try:
+            while self.num_of_channels > 0 and not self.stopped.is_set():
+                lines = self.file.readlines(self.chunk_size)
+                if len(lines) == 0:
+                    break
+
+                # a frame may end in the next chunk, carry its values over
+                values = np.concatenate([rest, parse_motion(lines, 1).ravel()])
+                num_of_frames = len(values) // self.num_of_channels
+                rest = values[num_of_frames * self.num_of_channels:]
+
+                with self.lock:
+                    self.buffer.extend(values[:len(values) - len(rest)].reshape(-1, self.num_of_channels))
+
+            if not self.stopped.is_set():
+                check_motion_size(len(self.buffer) * self.num_of_channels + len(rest),
+                                  self.num_of_frames, self.num_of_channels)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.file.close()
+            self.done = True
+
+        if self.cache and self.error is None and not self.stopped.is_set():
+            bvhcache.store(self.filename, self.bvh.header(), self.motion())
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+CACHE_DIR_NAME = '.bvhcache'
+
+# magic, version, header length; the header is JSON and the float32 motion
+# matrix follows at the next ALIGN boundary
+MAGIC = b'BVHC'
+VERSION = 1
+PREFIX = struct.Struct('<4sII')
+ALIGN = 64
+
+WRITE_BLOCK = 1 << 16  # rows
+
+
+def cache_path(filename):
+    filename = os.path.abspath(filename)
+    name = hashlib.sha1(filename.encode()).hexdigest() + '.bvhc'
+
+    return os.path.join(os.path.dirname(filename), CACHE_DIR_NAME, name)
+
+
+def _source_stamp(filename):
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def lookup(filename):
+    # (header, motion) of a valid cache entry, motion is memory-mapped
+    path = cache_path(filename)
+
+    try:
+        with open(path, 'rb') as f:
+            magic, version, header_len = PREFIX.unpack(f.read(PREFIX.size))
+            if magic != MAGIC or version != VERSION:
+                return None
+
+            header = json.loads(f.read(header_len).decode())
+    except (OSError, ValueError, struct.error):
+        return None
+
+    # the source changed since the entry was written
+    if header.get('source') != _source_stamp(filename):
+        return None
+
+    shape = (header['num_of_frames'], header['num_of_channels'])
+    if shape[0] * shape[1] == 0:
+        return header, np.zeros(shape, dtype=np.float32)
+
+    motion = np.memmap(path, dtype=np.float32, mode='r', offset=header['data_offset'], shape=shape)
+
+    return header, motion
+
+
+def store(filename, header, motion):
+    path = cache_path(filename)
+
+    header = dict(header)
+    header['source'] = _source_stamp(filename)
+    header['num_of_frames'], header['num_of_channels'] = motion.shape
+
+    body = json.dumps(header).encode()
+    # data_offset is part of the header, so reserve room for its digits
+    data_offset = -(-(PREFIX.size + len(body) + 32) // ALIGN) * ALIGN
+    header['data_offset'] = data_offset
+    body = json.dumps(header).encode()
+
+    tmp = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # write to a temporary file first so readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(PREFIX.pack(MAGIC, VERSION, len(body)))
+            f.write(body)
+            f.write(b'\0' * (data_offset - PREFIX.size - len(body)))
+
+            # convert in row blocks to keep the extra memory small
+            for start in range(0, len(motion), WRITE_BLOCK):
+                motion[start:start + WRITE_BLOCK].astype(np.float32).tofile(f)
+
+        os.replace(tmp, path)
+    except OSError:
+        # caching is best effort, e.g. read-only motion directories
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
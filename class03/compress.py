@@ -0,0 +1,245 @@
+import json
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from bvh import BVH
+from kinematics import skeleton_size
+
+# magic, version, header length; the JSON header is followed by the zlib
+# compressed key frame gaps, quantized key values and raw float64 key
+# values of the channels a quantization step is too coarse for
+MAGIC = b'BVHZ'
+VERSION = 2
+PREFIX = struct.Struct('<4sII')
+
+# default bound of the decoded rotation channels, in degrees
+MAX_ANGLE_ERROR = .5
+
+# default bound of the position channels, relative to the skeleton size
+POSITION_ERROR_RATIO = 1e-3
+
+QUANTIZATION_LEVELS = 65535
+
+
+def rotation_channels(skeleton):
+    # (C,) True for the rotation columns of the motion
+    rotation = np.zeros(skeleton.num_of_channels, dtype=bool)
+    for j, channels in enumerate(skeleton.channels):
+        for i, ch in enumerate(channels):
+            rotation[skeleton.channel_index[j] + i] = ch.endswith('ROTATION')
+
+    return rotation
+
+
+def channel_tolerances(bvh, max_angle_error, max_position_error=None):
+    # (C,) allowed absolute error of every motion column
+    skeleton = bvh.skeleton
+
+    if max_position_error is None:
+        max_position_error = POSITION_ERROR_RATIO * skeleton_size(skeleton)
+
+    return np.where(rotation_channels(skeleton), max_angle_error, max_position_error)
+
+
+def quantize(motion):
+    # per-channel int16 with stored ranges: value = lo + (q + 32768) * scale
+    lo = motion.min(axis=0)
+    scale = (motion.max(axis=0) - lo) / QUANTIZATION_LEVELS
+    scale[scale == 0] = 1.
+
+    q = np.round((motion - lo) / scale) - 32768
+    return q.astype(np.int16), lo, scale
+
+
+def dequantize(q, lo, scale):
+    return lo + (q.astype(np.float64) + 32768) * scale
+
+
+def interpolate_keys(keys, values, num_of_frames, num_of_channels):
+    # (N, C) motion from per-channel key frames. keys are the flat positions
+    # c * N + frame of every key, channel by channel, and every channel has
+    # keys on its first and last frame, so one np.interp over the whole
+    # flattened motion never blends two channels.
+    x = np.arange(num_of_frames * num_of_channels)
+    flat = np.interp(x, keys, values)
+
+    return np.ascontiguousarray(flat.reshape(num_of_channels, num_of_frames).T)
+
+
+def reduce_keys(motion, approx, tolerances):
+    # (K,) flat key positions (see interpolate_keys) whose interpolation of
+    # approx, the quantized motion, stays within tolerances of motion. Every
+    # pass splits all segments of all channels that are still too far off
+    # at their worst frame, like Douglas-Peucker on the whole clip at once.
+    num_of_frames, num_of_channels = motion.shape
+    target = motion.T.ravel()
+    approx = approx.T.ravel()
+    tolerances = np.repeat(tolerances, num_of_frames)
+
+    is_key = np.zeros(len(target), dtype=bool)
+    is_key[::num_of_frames] = True
+    is_key[num_of_frames - 1::num_of_frames] = True
+
+    x = np.arange(len(target))
+    while True:
+        keys = np.flatnonzero(is_key)
+        error = np.abs(np.interp(x, keys, approx[keys]) - target) / tolerances
+        # keys can't be split again (their own quantization error may be
+        # above tolerances already)
+        error[keys] = 0
+
+        # worst frame of every segment from one key up to the next
+        seg_max = np.maximum.reduceat(error, keys)
+        failing = seg_max > 1
+        if not failing.any():
+            return keys
+
+        seg = np.repeat(np.arange(len(keys)), np.diff(keys, append=len(target)))
+        worst = np.flatnonzero((error == seg_max[seg]) & failing[seg])
+        worst = worst[np.flatnonzero(np.diff(seg[worst], prepend=-1))]
+        is_key[worst] = True
+
+        # a worst frame near either end of its segment splits off little,
+        # the midpoint is added too so the number of passes stays
+        # logarithmic in the segment lengths
+        a, b = keys[seg[worst]], keys[seg[worst] + 1]
+        skewed = 8 * np.minimum(worst - a, b - worst) < b - a
+        is_key[(a[skewed] + b[skewed]) // 2] = True
+
+
+def compress_motion(bvh, max_angle_error=MAX_ANGLE_ERROR, max_position_error=None):
+    # -> (header, payload) of the compressed motion
+    motion = bvh.motion
+    if not np.isfinite(motion).all():
+        raise ValueError('motion contains NaN or infinite values')
+
+    header = bvh.header()
+    header['num_of_frames'], header['num_of_channels'] = motion.shape
+
+    if motion.size == 0:
+        header.update(lo=[], scale=[], num_of_keys=0, raw_channels=[], max_errors=[0., 0.])
+        return header, zlib.compress(b'')
+
+    num_of_frames = len(motion)
+    q, lo, scale = quantize(motion)
+    tolerances = channel_tolerances(bvh, max_angle_error, max_position_error)
+
+    # the quantization error of a key counts against the bound as well; a
+    # channel whose half step is above its tolerance keeps raw key values
+    raw = (motion.max(axis=0) - lo) / QUANTIZATION_LEVELS / 2 >= tolerances
+    q[:, raw] = -32768
+    approx = dequantize(q, lo, scale)
+    approx[:, raw] = motion[:, raw]
+
+    keys = reduce_keys(motion, approx, tolerances)
+
+    # the bound is checked on the decoded motion, not assumed
+    error = np.abs(interpolate_keys(keys, approx.T.ravel()[keys], *motion.shape) - motion).max(axis=0)
+    if (error > tolerances).any():
+        raise ValueError('decoded motion exceeds the error bound on channels %s' % (
+            np.flatnonzero(error > tolerances).tolist()))
+
+    # gaps between the key frames of a channel (0 at its first key) and
+    # deltas of the key values along the flattened channels; a wrapping
+    # int16 cumsum undoes them exactly. The low & high bytes of the deltas
+    # are stored apart, zlib finds much more to compress that way.
+    gaps = np.diff(keys, prepend=0).astype(np.uint32)
+    gaps[keys % num_of_frames == 0] = 0
+    deltas = np.diff(q.T.ravel()[keys], prepend=0).astype(np.int16)
+    planes = deltas.view(np.uint8).reshape(-1, 2).T
+    raw_values = motion.T.ravel()[keys[raw[keys // num_of_frames]]].astype(np.float64)
+
+    rotation = rotation_channels(bvh.skeleton)
+    header.update(lo=lo.tolist(), scale=scale.tolist(), num_of_keys=len(keys),
+                  raw_channels=np.flatnonzero(raw).tolist(), max_angle_error=max_angle_error,
+                  max_errors=[float(error[rotation].max(initial=0)), float(error[~rotation].max(initial=0))])
+
+    return header, zlib.compress(gaps.tobytes() + planes.tobytes() + raw_values.tobytes(), 9)
+
+
+def decompress_motion(header, payload):
+    num_of_frames, num_of_channels = header['num_of_frames'], header['num_of_channels']
+    num_of_keys = header['num_of_keys']
+
+    if num_of_keys == 0:
+        return BVH.from_header(header, np.zeros((num_of_frames, num_of_channels)))
+
+    data = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+    gaps = data[:4 * num_of_keys].view(np.uint32)
+
+    # a zero gap starts the next channel
+    channel = np.cumsum(gaps == 0) - 1
+    keys = np.cumsum(gaps, dtype=np.int64)
+    keys += channel * num_of_frames - np.maximum.accumulate(np.where(gaps == 0, keys, 0))
+
+    planes = data[4 * num_of_keys:6 * num_of_keys].reshape(2, -1)
+    q = np.cumsum(np.ascontiguousarray(planes.T).view(np.int16).ravel(), dtype=np.int16)
+
+    values = dequantize(q, np.array(header['lo'])[channel], np.array(header['scale'])[channel])
+    values[np.isin(channel, header['raw_channels'])] = data[6 * num_of_keys:].view(np.float64)
+
+    return BVH.from_header(header, interpolate_keys(keys, values, num_of_frames, num_of_channels))
+
+
+def save_compressed(bvh, filename, max_angle_error=MAX_ANGLE_ERROR, max_position_error=None):
+    header, payload = compress_motion(bvh, max_angle_error, max_position_error)
+    body = json.dumps(header).encode()
+
+    with open(filename, 'wb') as f:
+        f.write(PREFIX.pack(MAGIC, VERSION, len(body)))
+        f.write(body)
+        f.write(payload)
+
+    return header
+
+
+def load_compressed(filename):
+    with open(filename, 'rb') as f:
+        magic, version, header_len = PREFIX.unpack(f.read(PREFIX.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a compressed BVH motion file' % filename)
+
+        header = json.loads(f.read(header_len).decode())
+        payload = f.read()
+
+    return decompress_motion(header, payload)
+
+
+def max_errors(bvh, decoded):
+    # largest absolute error of the rotation channels and position channels
+    rotation = rotation_channels(bvh.skeleton)
+    error = np.abs(decoded.motion - bvh.motion).max(axis=0, initial=0)
+    return error[rotation].max(initial=0), error[~rotation].max(initial=0)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    from bvh import load_bvh
+
+    filename = sys.argv[1]
+    max_angle_error = float(sys.argv[2]) if len(sys.argv) > 2 else MAX_ANGLE_ERROR
+    output = os.path.splitext(filename)[0] + '.bvhz'
+
+    bvh = load_bvh(filename, cache=False)
+
+    start = time.perf_counter()
+    header = save_compressed(bvh, output, max_angle_error)
+    encode = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = load_compressed(output)
+    decode = time.perf_counter() - start
+
+    angle, position = max_errors(bvh, decoded)
+    print('%s: %d frames, %d of %d channel values kept as keys (%.1f%%)' % (
+        output, bvh.num_of_frames, header['num_of_keys'], bvh.motion.size,
+        100 * header['num_of_keys'] / max(bvh.motion.size, 1)))
+    print('Size: %d -> %d bytes, ratio %.1f' % (
+        os.path.getsize(filename), os.path.getsize(output), os.path.getsize(filename) / os.path.getsize(output)))
+    print('Max error: %.4f deg (bound %.4f), position %.5f; %d channels with raw keys' % (
+        angle, max_angle_error, position, len(header['raw_channels'])))
+    print('Encode %.3f s, decode %.2f ms' % (encode, decode * 1e3))
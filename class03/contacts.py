@@ -0,0 +1,156 @@
+import json
+
+import numpy as np
+
+from kinematics import joint_positions, rest_positions, root_motion, skeleton_size
+
+# joints this low in the rest pose (relative to the skeleton size) are feet
+FOOT_HEIGHT_RATIO = .15
+
+# contact starts below the on thresholds and ends above the off ones;
+# heights are above the joint's own ground level, both relative to the
+# skeleton size (speeds per second)
+HEIGHT_ON, HEIGHT_OFF = .02, .04
+SPEED_ON, SPEED_OFF = .15, .3
+
+# a joint's ground level is this percentile of its heights over the clip
+GROUND_PERCENTILE = 5
+
+# root trajectory samples per second and smoothing (seconds)
+TRAJECTORY_FPS = 10
+TRAJECTORY_SIGMA = .1
+
+
+def foot_joints(skeleton):
+    # joints (end sites included) close to the lowest point of the rest pose
+    rest = rest_positions(skeleton)
+    height = rest[:, 1] - rest[:, 1].min()
+
+    feet = np.flatnonzero(height <= FOOT_HEIGHT_RATIO * skeleton_size(skeleton))
+    return feet[feet != 0]
+
+
+def joint_velocities(positions, fps):
+    # (F, J, 3) -> (F, J, 3) central differences, one sided at the ends
+    if len(positions) < 2:
+        return np.zeros_like(positions)
+
+    return np.gradient(positions, axis=0) * fps
+
+
+def hysteresis(on, off):
+    # (F, ...) bool: a flag turns on where on holds and stays on until off
+    # holds. The last frame deciding the state is forward filled, so the
+    # whole clip is labelled without a loop over frames.
+    F = len(on)
+    frames = np.arange(F).reshape((F,) + (1,) * (on.ndim - 1))
+
+    decided = np.maximum.accumulate(np.where(on | off, frames, -1), axis=0)
+    state = np.take_along_axis(on, np.maximum(decided, 0), axis=0)
+
+    return state & (decided >= 0)
+
+
+def foot_contacts(bvh, feet=None, positions=None):
+    # (F, len(feet)) contact flags of the foot joints
+    skeleton = bvh.skeleton
+    if feet is None:
+        feet = foot_joints(skeleton)
+    if positions is None:
+        positions = joint_positions(skeleton, bvh.motion)
+
+    size = skeleton_size(skeleton)
+    p = positions[:, feet]
+
+    height = p[..., 1] - np.percentile(p[..., 1], GROUND_PERCENTILE, axis=0)
+    speed = np.linalg.norm(joint_velocities(p, bvh.fps), axis=-1)
+
+    on = (height < HEIGHT_ON * size) & (speed < SPEED_ON * size)
+    off = (height > HEIGHT_OFF * size) | (speed > SPEED_OFF * size)
+
+    return hysteresis(on, off)
+
+
+def contact_ranges(contacts):
+    # (F,) flags -> (N, 2) [start, end) frame ranges of the contacts
+    edges = np.diff(np.concatenate([[0], contacts.astype(np.int8), [0]]))
+    return np.stack([np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)], axis=-1)
+
+
+def gaussian_smooth(values, sigma):
+    # (F, ...) values smoothed along the frames, edges padded with the
+    # first & last values
+    radius = int(np.ceil(3 * sigma))
+    if radius == 0 or len(values) < 2:
+        return values.copy()
+
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-.5 * (x / sigma) ** 2)
+    kernel /= kernel.sum()
+
+    flat = values.reshape(len(values), -1)
+    padded = np.concatenate([np.repeat(flat[:1], radius, axis=0), flat, np.repeat(flat[-1:], radius, axis=0)])
+
+    # a sliding window view weighted by the kernel: (F, columns, 2r + 1) @ (2r + 1,)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, len(kernel), axis=0)
+    return (windows @ kernel).reshape(values.shape)
+
+
+def root_trajectory(bvh, fps=TRAJECTORY_FPS, sigma=TRAJECTORY_SIGMA):
+    # smoothed root path on the ground, sampled at fps:
+    # (T,) times, (T, 3) positions, (T, 2) unit xz facing directions
+    position, facing = root_motion(bvh.skeleton, bvh.motion)
+    if len(position) == 0:
+        return np.zeros(0), np.zeros((0, 3)), np.zeros((0, 2))
+
+    position = position * [1., 0., 1.]
+    position = gaussian_smooth(position, sigma * bvh.fps)
+
+    facing = gaussian_smooth(facing, sigma * bvh.fps)
+    facing /= np.maximum(np.linalg.norm(facing, axis=-1, keepdims=True), 1e-8)
+
+    step = max(int(round(bvh.fps / fps)), 1)
+    frames = np.arange(0, len(position), step)
+
+    return frames / bvh.fps, position[frames], facing[frames]
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    from bvh import load_bvh
+
+    bvh = load_bvh(sys.argv[1])
+
+    start = time.perf_counter()
+    positions = joint_positions(bvh.skeleton, bvh.motion)
+    fk = time.perf_counter()
+
+    feet = foot_joints(bvh.skeleton)
+    names = [bvh.skeleton.names[bvh.skeleton.parents[j]] + ' end' if bvh.skeleton.is_end[j]
+             else bvh.skeleton.names[j] for j in feet]
+
+    contacts = foot_contacts(bvh, feet, positions)
+    times, trajectory, facing = root_trajectory(bvh)
+    end = time.perf_counter()
+
+    print('%d frames: FK %.1f ms, contacts & trajectory %.1f ms' % (
+        bvh.num_of_frames, (fk - start) * 1e3, (end - fk) * 1e3))
+    for k in range(len(feet)):
+        ranges = contact_ranges(contacts[:, k])
+        print('%-16s %5.1f%% in contact, %d contacts' % (
+            names[k], 100 * contacts[:, k].mean() if len(contacts) else 0., len(ranges)))
+    print('Root path: %d samples, %.2f long' % (
+        len(trajectory), np.linalg.norm(np.diff(trajectory, axis=0), axis=-1).sum()))
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'wt') as f:
+            json.dump({
+                'feet': names,
+                'contacts': [contact_ranges(contacts[:, k]).tolist() for k in range(len(feet))],
+                'trajectory': {
+                    'time': times.tolist(),
+                    'position': trajectory.tolist(),
+                    'facing': facing.tolist(),
+                },
+            }, f, indent=2)
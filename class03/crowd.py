@@ -0,0 +1,152 @@
+import time
+
+import numpy as np
+
+from kinematics import forward_kinematics, motion_or_rest_pose, skeleton_size
+from renderer import LineBuffer, SkeletonRenderer
+
+
+# frame time of the crowd preview, 60 fps
+FRAME_BUDGET = 1 / 60.
+
+
+def yaw_placements(positions, yaws):
+    # (N, 3) root placements and (N,) rotations about +Y in radians -> (N, 4, 4)
+    c, s = np.cos(yaws), np.sin(yaws)
+
+    P = np.zeros((len(yaws), 4, 4))
+    P[:, 0, 0] = c
+    P[:, 0, 2] = s
+    P[:, 1, 1] = 1.
+    P[:, 2, 0] = -s
+    P[:, 2, 2] = c
+    P[:, :3, 3] = positions
+    P[:, 3, 3] = 1.
+
+    return P
+
+
+class FrameTimer:
+    # Accumulates per-section frame times and prints their averages against
+    # the frame budget every interval seconds.
+    def __init__(self, budget=FRAME_BUDGET, interval=1.):
+        self.budget = budget
+        self.interval = interval
+
+        self.sections = {}
+        self.num_of_frames = 0
+        self.last_report = time.perf_counter()
+
+    def add(self, name, seconds):
+        self.sections[name] = self.sections.get(name, 0.) + seconds
+
+    def end_frame(self, title=''):
+        self.num_of_frames += 1
+
+        now = time.perf_counter()
+        if now - self.last_report < self.interval:
+            return
+
+        n = self.num_of_frames
+        total = sum(self.sections.values()) / n
+        parts = ', '.join('%s %.2f ms' % (name, t / n * 1e3) for name, t in self.sections.items())
+
+        print('%s%.1f fps | %s | total %.2f ms (%.0f%% of %.2f ms budget)%s' % (
+            title, n / (now - self.last_report), parts, total * 1e3,
+            total / self.budget * 100, self.budget * 1e3, '' if total <= self.budget else ' OVER'),
+            flush=True)
+
+        self.sections = {}
+        self.num_of_frames = 0
+        self.last_report = now
+
+
+class Crowd:
+    # Many characters playing BVH clips with their own time offset and root
+    # placement. Forward kinematics runs once per clip per frame for all of
+    # its characters and every bone is drawn from one shared vertex buffer.
+    def __init__(self, clips):
+        self.clips = clips
+        self.renderers = [SkeletonRenderer(bvh.skeleton) for bvh in clips]
+
+        self.clip_index = np.zeros(0, dtype=np.int64)
+        self.time_offsets = np.zeros(0)
+        self.placements = np.zeros((0, 4, 4))
+
+        self.buffer = LineBuffer()
+        self.timer = FrameTimer()
+
+    def __len__(self):
+        return len(self.clip_index)
+
+    def add(self, clip_index, time_offsets, placements):
+        # clip_index, time_offsets: (N,), placements: (N, 4, 4)
+        self.clip_index = np.concatenate([self.clip_index, clip_index])
+        self.time_offsets = np.concatenate([self.time_offsets, time_offsets])
+        self.placements = np.concatenate([self.placements, placements])
+
+    @staticmethod
+    def grid(clips, num_of_characters, spacing=None, seed=0, num_of_frames=None):
+        # characters on a square grid around the origin with random clips,
+        # time offsets and headings; num_of_frames overrides the clip lengths
+        # the offsets are drawn from (the announced length of a clip still
+        # streaming in)
+        crowd = Crowd(clips)
+        rng = np.random.default_rng(seed)
+
+        if spacing is None:
+            # about one and a half body sizes apart, measured on the rest pose
+            spacing = 1.5 * max(skeleton_size(bvh.skeleton) for bvh in clips)
+
+        side = int(np.ceil(np.sqrt(num_of_characters)))
+        i = np.arange(num_of_characters)
+
+        positions = np.zeros((num_of_characters, 3))
+        positions[:, 0] = (i % side - (side - 1) / 2) * spacing
+        positions[:, 2] = (i // side - (side - 1) / 2) * spacing
+
+        if num_of_frames is None:
+            num_of_frames = [bvh.num_of_frames for bvh in clips]
+        durations = np.array([max(n, 1) / bvh.fps for n, bvh in zip(num_of_frames, clips)])
+        clip_index = rng.integers(len(clips), size=num_of_characters)
+
+        crowd.add(clip_index,
+                  rng.random(num_of_characters) * durations[clip_index],
+                  yaw_placements(positions, rng.random(num_of_characters) * 2 * np.pi))
+
+        return crowd
+
+    def update(self, t):
+        # evaluate every character at playback time t and refill the buffer
+        start = time.perf_counter()
+
+        positions = []
+        for c, bvh in enumerate(self.clips):
+            characters = np.flatnonzero(self.clip_index == c)
+            if len(characters) == 0:
+                continue
+
+            motion = motion_or_rest_pose(bvh)
+            frames = ((t + self.time_offsets[characters]) * bvh.fps).astype(np.int64) % len(motion)
+
+            # (N, J, 3) joint positions, then placed in the world
+            G = forward_kinematics(bvh.skeleton, motion[frames])
+            P = self.placements[characters]
+            p = G[..., :3, 3] @ np.swapaxes(P[:, :3, :3], -1, -2) + P[:, None, :3, 3]
+
+            positions.append((c, p))
+
+        fk = time.perf_counter()
+        self.timer.add('fk', fk - start)
+
+        vertices = [self.renderers[c].lines(p) for c, p in positions]
+        self.buffer.set_vertices(np.concatenate(vertices) if vertices else np.zeros((0, 3), dtype=np.float32))
+
+        self.timer.add('lines', time.perf_counter() - fk)
+
+    def render(self):
+        start = time.perf_counter()
+        self.buffer.render()
+        self.timer.add('draw', time.perf_counter() - start)
+
+        self.timer.end_frame('[Crowd] %d characters: ' % len(self))
@@ -0,0 +1,410 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+AXIS_PLANES = {'X': (1, 2), 'Y': (2, 0), 'Z': (0, 1)}
+
+
+def rotation_matrices(axis, angles):
+    # angles: (...) in degrees -> (..., 3, 3) rotations about axis 'X', 'Y' or 'Z'
+    th = np.radians(angles)
+    c, s = np.cos(th), np.sin(th)
+
+    R = np.zeros(np.shape(th) + (3, 3))
+    i, j = AXIS_PLANES[axis]
+    k = 3 - i - j
+
+    R[..., k, k] = 1.
+    R[..., i, i] = c
+    R[..., i, j] = -s
+    R[..., j, i] = s
+    R[..., j, j] = c
+
+    return R
+
+
+def euler_to_matrices(angles, order):
+    # angles: (..., len(order)) in degrees, order: rotation channel axes as
+    # listed in the file, e.g. 'ZXY' -> (..., 3, 3) = Rz @ Rx @ Ry
+    R = rotation_matrices(order[0], angles[..., 0])
+
+    # batched matmul beats einsum for stacks of small matrices
+    for a, axis in enumerate(order[1:], 1):
+        R = R @ rotation_matrices(axis, angles[..., a])
+
+    return R
+
+
+def quaternion_multiply(q1, q2):
+    # (..., 4) quaternions as (w, x, y, z) -> (..., 4) Hamilton product
+    w1, x1, y1, z1 = np.moveaxis(q1, -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(q2, -1, 0)
+
+    return np.stack([w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+                     w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+                     w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+                     w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2], axis=-1)
+
+
+def euler_to_quaternions(angles, order):
+    # same as euler_to_matrices but -> (..., 4) unit quaternions
+    th = np.radians(np.moveaxis(angles, -1, 0)) / 2
+    c, s = np.cos(th), np.sin(th)
+
+    # components as separate arrays, zero ones as scalars
+    q = [c[0], 0., 0., 0.]
+    q[1 + 'XYZ'.index(order[0])] = s[0]
+
+    for a, axis in enumerate(order[1:], 1):
+        # q * (c + s * e_axis)
+        w, v = q[0], q[1:]
+        k = 'XYZ'.index(axis)
+        i, j = (k + 1) % 3, (k + 2) % 3
+
+        r = [None] * 4
+        r[0] = w * c[a] - v[k] * s[a]
+        r[1 + k] = v[k] * c[a] + w * s[a]
+        r[1 + i] = v[i] * c[a] + v[j] * s[a]
+        r[1 + j] = v[j] * c[a] - v[i] * s[a]
+        q = r
+
+    return np.stack(np.broadcast_arrays(*q), axis=-1)
+
+
+def quaternions_to_matrices(q):
+    # (..., 4) unit quaternions -> (..., 3, 3) rotations
+    R = np.empty(q.shape[:-1] + (3, 3))
+    for a in range(3):
+        for b in range(3):
+            R[..., a, b] = quaternion_matrix_element(np.moveaxis(q, -1, 0), a, b)
+
+    return R
+
+
+def quaternion_matrix_element(q, a, b):
+    # q: (4, ...) unit quaternion components -> (...) entry (a, b) of their
+    # rotation matrices
+    w, v = q[0], q[1:]
+
+    if a == b:
+        i, j = (a + 1) % 3, (a + 2) % 3
+        return 1 - 2 * (v[i] * v[i] + v[j] * v[j])
+
+    k = 3 - a - b
+    sign = 1. if (b - a) % 3 == 1 else -1.
+    return 2 * (v[a] * v[b] - sign * w * v[k])
+
+
+def euler_from_elements(element, order):
+    # element(a, b): (...) entries of the rotation matrices, for three
+    # distinct axes -> (..., 3) angles in degrees, the middle one within
+    # [-90, 90]
+    i, j, k = ('XYZ'.index(axis) for axis in order)
+
+    # +1 for the cyclic orders XYZ, YZX and ZXY
+    sign = 1. if (j - i) % 3 == 1 else -1.
+
+    return np.degrees(np.stack([
+        np.arctan2(-sign * element(j, k), element(k, k)),
+        np.arcsin(np.clip(sign * element(i, k), -1., 1.)),
+        np.arctan2(-sign * element(i, j), element(i, i))], axis=-1))
+
+
+def matrices_to_euler(R, order):
+    # inverse of euler_to_matrices, e.g. order 'ZXY'
+    return euler_from_elements(lambda a, b: R[..., a, b], order)
+
+
+def quaternions_to_euler(q, order):
+    # inverse of euler_to_quaternions, only the five matrix entries needed
+    # are formed
+    q = np.ascontiguousarray(np.moveaxis(q, -1, 0))
+    return euler_from_elements(lambda a, b: quaternion_matrix_element(q, a, b), order)
+
+
+def slerp(q0, q1, t):
+    # (..., 4) unit quaternions, t: (...) in [0, 1] -> (..., 4)
+    t = np.asarray(t)[..., None]
+    dot = np.einsum('...i,...i->...', q0, q1)[..., None]
+
+    # take the short way around
+    q1 = np.where(dot < 0, -q1, q1)
+    dot = np.abs(dot)
+
+    theta = np.arccos(np.minimum(dot, 1.))
+    sin_theta = np.sin(theta)
+
+    # nearly parallel quaternions fall back to a linear blend
+    near = sin_theta < 1e-6
+    safe = np.where(near, 1., sin_theta)
+
+    w0 = np.where(near, 1 - t, np.sin((1 - t) * theta) / safe)
+    w1 = np.where(near, t, np.sin(t * theta) / safe)
+
+    q = w0 * q0 + w1 * q1
+    return q / np.sqrt(np.einsum('...i,...i->...', q, q))[..., None]
+
+
+def channel_groups(skeleton):
+    # group the joints by their rotation channel order:
+    # {order: (joint indices, (J, len(order)) motion columns)}
+    groups = {}
+
+    for j, channels in enumerate(skeleton.channels):
+        cols = [skeleton.channel_index[j] + i for i, ch in enumerate(channels)
+                if ch.endswith('ROTATION')]
+        if len(cols) == 0:
+            continue
+
+        order = ''.join(ch[0] for ch in channels if ch.endswith('ROTATION'))
+        joints, columns = groups.setdefault(order, ([], []))
+        joints.append(j)
+        columns.append(cols)
+
+    return {order: (np.array(joints), np.array(columns)) for order, (joints, columns) in groups.items()}
+
+
+def motion_or_rest_pose(bvh):
+    # a motion without frames yields the rest pose as a single frame
+    if bvh.num_of_frames == 0:
+        return np.zeros((1, bvh.skeleton.num_of_channels))
+
+    return bvh.motion
+
+
+def local_rotations(skeleton, motion):
+    # motion: (..., C) -> (..., J, 3, 3) rotation of every joint relative
+    # to its parent; leading dimensions (frames, characters, ...) are kept
+    batch = motion.shape[:-1]
+
+    R = np.empty(batch + (len(skeleton), 3, 3))
+    R[:] = np.eye(3)
+
+    # one batched conversion per distinct channel order
+    for order, (joints, columns) in channel_groups(skeleton).items():
+        R[..., joints, :, :] = euler_to_matrices(motion[..., columns], order)
+
+    return R
+
+
+def local_translations(skeleton, motion):
+    # motion: (..., C) -> (..., J, 3) offset of every joint plus its
+    # position channels
+    t = np.empty(motion.shape[:-1] + (len(skeleton), 3))
+    t[:] = skeleton.offsets
+
+    for j, channels in enumerate(skeleton.channels):
+        for i, ch in enumerate(channels):
+            if ch.endswith('POSITION'):
+                t[..., j, 'XYZ'.index(ch[0])] += motion[..., skeleton.channel_index[j] + i]
+
+    return t
+
+
+def forward_kinematics(skeleton, motion):
+    # motion: (..., C) -> (..., J, 4, 4) global transforms of every joint
+    R = local_rotations(skeleton, motion)
+    t = local_translations(skeleton, motion)
+
+    # work joint-major so gathering parents copies contiguous blocks
+    R = np.ascontiguousarray(np.moveaxis(R, -3, 0))
+    t = np.ascontiguousarray(np.moveaxis(t, -2, 0))
+
+    # global rotations & positions
+    GR = np.empty_like(R)
+    Gt = np.empty_like(t)
+
+    root = skeleton.levels[0]
+    GR[root] = R[root]
+    Gt[root] = t[root]
+
+    # sweep the hierarchy level by level, all joints of a level at once
+    for joints in skeleton.levels[1:]:
+        parents = skeleton.parents[joints]
+
+        PR = GR[parents]
+        GR[joints] = PR @ R[joints]
+        Gt[joints] = (PR @ t[joints][..., None])[..., 0] + Gt[parents]
+
+    G = np.zeros(R.shape[1:-2] + (len(skeleton), 4, 4))
+    G[..., :3, :3] = np.moveaxis(GR, 0, -3)
+    G[..., :3, 3] = np.moveaxis(Gt, 0, -2)
+    G[..., 3, 3] = 1.
+
+    return G
+
+
+def joint_positions(skeleton, motion, block=8192):
+    # motion: (F, C) -> (F, J, 3) world position of every joint; forward
+    # kinematics runs on blocks of frames so the (block, J, 4, 4)
+    # transforms stay small for long clips
+    positions = np.empty((len(motion), len(skeleton), 3))
+
+    for start in range(0, len(motion), block):
+        positions[start:start + block] = forward_kinematics(skeleton, motion[start:start + block])[..., :3, 3]
+
+    return positions
+
+
+def rest_transforms(skeleton):
+    # (J, 4, 4) global transforms with every channel at zero, the rest pose
+    return forward_kinematics(skeleton, np.zeros(skeleton.num_of_channels))
+
+
+def rest_positions(skeleton):
+    # (J, 3) joint positions of the rest pose
+    return rest_transforms(skeleton)[:, :3, 3]
+
+
+def skeleton_size(skeleton):
+    # largest extent of the rest pose, never zero
+    return max(np.ptp(rest_positions(skeleton), axis=0).max(), 1e-3)
+
+
+def root_motion(skeleton, motion):
+    # (F, 3) root positions and (F, 2) unit facing directions on the xz
+    # plane (the root's local +Z axis)
+    channels = skeleton.channels[0]
+    base = skeleton.channel_index[0]
+
+    position = np.empty((len(motion), 3))
+    position[:] = skeleton.offsets[0]
+    for i, ch in enumerate(channels):
+        if ch.endswith('POSITION'):
+            position[:, 'XYZ'.index(ch[0])] += motion[:, base + i]
+
+    cols = [base + i for i, ch in enumerate(channels) if ch.endswith('ROTATION')]
+    order = ''.join(ch[0] for ch in channels if ch.endswith('ROTATION'))
+    if len(cols) > 0:
+        forward = euler_to_matrices(motion[:, cols], order)[:, [0, 2], 2]
+    else:
+        forward = np.tile([0., 1.], (len(motion), 1))
+
+    norm = np.linalg.norm(forward, axis=-1, keepdims=True)
+    facing = np.where(norm > 1e-8, forward / np.maximum(norm, 1e-8), [0., 1.])
+
+    return position, facing
+
+
+class PoseCache:
+    # Global transforms computed on demand in blocks of frames. At most
+    # budget bytes of blocks are kept (least recently used ones are
+    # dropped) and upcoming blocks can be prefetched on a background thread.
+    def __init__(self, skeleton, motion, block_size=256, budget=256 << 20):
+        self.skeleton = skeleton
+        self.motion = motion
+        self.block_size = block_size
+
+        block_bytes = block_size * len(skeleton) * 16 * np.dtype(float).itemsize
+        self.max_blocks = max(2, budget // block_bytes)
+
+        self.blocks = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return len(self.motion)
+
+    def __getitem__(self, frame):
+        # (J, 4, 4) global transforms of frame
+        return self.block(frame // self.block_size)[frame % self.block_size]
+
+    def block(self, idx):
+        with self.lock:
+            if idx in self.blocks:
+                self.blocks.move_to_end(idx)
+                return self.blocks[idx]
+
+            future = self.pending.get(idx)
+
+        if future is not None:
+            return future.result()
+
+        return self._compute(idx)
+
+    def prefetch(self, frame, ahead=1):
+        num_of_blocks = -(-len(self) // self.block_size)
+        cur = frame // self.block_size
+
+        for i in range(1, ahead + 1):
+            # playback loops, so wrap around at the end of the clip
+            idx = (cur + i) % num_of_blocks
+
+            with self.lock:
+                if idx in self.blocks or idx in self.pending:
+                    continue
+                self.pending[idx] = self.executor.submit(self._compute, idx)
+
+    def set_motion(self, motion):
+        # motion grew (e.g. while streaming), the blocks cut short by the
+        # old end are stale; the frames before it did not change
+        with self.lock:
+            first_stale = len(self.motion) // self.block_size
+            self.motion = motion
+
+            for idx in [idx for idx in self.blocks if idx >= first_stale]:
+                del self.blocks[idx]
+            for idx in [idx for idx in self.pending if idx >= first_stale]:
+                del self.pending[idx]
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _compute(self, idx):
+        motion = self.motion
+        start = idx * self.block_size
+        G = forward_kinematics(self.skeleton, motion[start:start + self.block_size])
+
+        with self.lock:
+            if motion is not self.motion and len(G) < self.block_size:
+                # computed from a shorter motion than the current one
+                return G
+
+            self.blocks[idx] = G
+            self.blocks.move_to_end(idx)
+            self.pending.pop(idx, None)
+
+            while len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+
+        return G
+
+
+def local_rotations_per_frame(bvh):
+    # reference implementation: one small matrix product per channel
+    R = np.empty((bvh.num_of_frames, len(bvh.nodes), 3, 3))
+
+    for f in range(bvh.num_of_frames):
+        for node in bvh.nodes:
+            M = np.eye(3)
+            for i, ch in enumerate(node.channels):
+                if ch.endswith('ROTATION'):
+                    M = M @ rotation_matrices(ch[0], node.frames[f][i])
+            R[f, node.index] = M
+
+    return R
+
+
+if __name__ == '__main__':
+    import sys
+    from bvh import parse_bvh
+
+    with open(sys.argv[1], 'rt') as f:
+        bvh = parse_bvh(f.readlines())
+
+    print('Frames: %d, nodes: %d' % (bvh.num_of_frames, len(bvh.nodes)))
+
+    start = time.perf_counter()
+    batched = local_rotations(bvh.skeleton, bvh.motion)
+    print('Batched conversion: %.3f ms' % ((time.perf_counter() - start) * 1e3))
+
+    start = time.perf_counter()
+    reference = local_rotations_per_frame(bvh)
+    print('Per-frame loop: %.3f ms' % ((time.perf_counter() - start) * 1e3))
+
+    print('Max abs difference: %g' % np.abs(batched - reference).max())
@@ -1,156 +1,25 @@
-from enum import Enum
 import numpy as np
-import os
+import threading
 
 import glfw
 from OpenGL.GL import *
 from OpenGL.GLU import *
 
-class BVHParserState(Enum):
-    NONE = 0,
-    HIERARCHY = 1,
-    MOTION = 2
-
-class BVHNode:
-    def __init__(self, name, parent=None, is_end=False):
-        self.name = name
-        self.parent = parent
-        self.is_end = is_end
-
-        self.offset = np.zeros(3)
-        self.channels = []
-        self.frames = []
-
-        self.children = []
-
-    def render(self, frame):
-        glPushMatrix()
-        glTranslatef(*self.offset)
-
-        glBegin(GL_LINES)
-        glVertex3fv(np.zeros(3))
-        glVertex3fv(-self.offset)
-        glEnd()
-
-        if not self.is_end:
-            for c in self.children:
-                c.render(frame)
-
-        glPopMatrix()
-
-class BVH:
-    def __init__(self):
-        self.root = BVHNode('ROOT')
-
-        self.joints = []
-        self.num_of_frames = 0
-        self.fps = 0
-
-    def render(self, frame=-1):
-        self.root.render(frame)
-
-    def __repr__(self):
-        def _make_str(level, msg):
-            return '  ' * level + msg + os.linesep
-
-        result = ''
-
-        node_stack = [(self.root, 0)]
-
-        while node_stack:
-            node, level = node_stack[-1]
-            node_stack.pop()
-
-            result += _make_str(level, '<{}>'.format(node.name))
-            result += _make_str(level, 'offset: ' + str(node.offset))
-            result += _make_str(level, 'channel: ' + ', '.join(node.channels))
-            result += _make_str(level, 'is endpoint: {}'.format(node.is_end))
-
-            if not node.is_end:
-                result += _make_str(level, 'first frame: ' + str(node.frames[0]))
-                result += _make_str(level, 'last frame: ' + str(node.frames[-1]))
-
-                for c in node.children:
-                    node_stack.append((c, level+1))
-
-        return result
-
-
-def parse_bvh(lines):
-    state = BVHParserState.NONE
-
-    bvh = BVH()
-    cur_node = None
-    node_stack = [bvh.root]
-
-    tot_num_of_channels = 0
-    channels = []
-    frames = []
-
-    for line in lines:
-        line = line.strip()
-        key, *args = line.split()
-        key = key.upper()
-
-        if key == 'HIERARCHY':
-            state = BVHParserState.HIERARCHY
-            continue
-        elif key == 'MOTION':
-            state = BVHParserState.MOTION
-            continue
-
-        if state == BVHParserState.HIERARCHY:
-            if key == 'JOINT' or key == 'ROOT':
-                bvh.joints.append(args[0])
-
-            if key == '{':
-                node_stack.append(cur_node)
-            elif key == '}':
-                node_stack.pop()
-            elif key == 'ROOT':
-                cur_node = bvh.root
-                cur_node.name = args[0]
-            elif key == 'JOINT':
-                cur_node = BVHNode(args[0], node_stack[-1], False)
-                node_stack[-1].children.append(cur_node)
-            elif key == 'END':
-                cur_node = BVHNode(args[0], True)
-                node_stack[-1].children.append(cur_node)
-            elif key == 'OFFSET':
-                cur_node.offset = np.fromiter(map(float, args), dtype=float)
-            elif key == 'CHANNELS':
-                cur_node.channels.extend(list(map(lambda x: x.upper(), args[1:])))
-                channels.append([cur_node, int(args[0])])
-                tot_num_of_channels += int(args[0])
-
-        elif state == BVHParserState.MOTION:
-            if line.upper().startswith('FRAMES:'):
-                bvh.num_of_frames = int(args[-1])
-            elif line.upper().startswith('FRAME TIME:'):
-                bvh.fps = 1 / float(args[-1])
-            else:
-                frames.append(np.fromiter(map(float, line.split()), dtype=float))
-
-    # build frames
-    print(tot_num_of_channels)
-    for frame_idx in range(bvh.num_of_frames):
-        ch_idx = 0
-
-        for node, cnt in channels:
-            node.frames.append(frames[frame_idx][ch_idx:ch_idx+cnt])
-            ch_idx += cnt
-
-    return bvh
-
-'''
-*******************************
-* Main Program                *
-*******************************
-'''
+from bvh import BVHStream, load_bvh
+from crowd import Crowd
+from kinematics import PoseCache, motion_or_rest_pose
+from renderer import SkeletonRenderer
+from skinning import Skin, fit_to_skeleton, obj_mesh_loader
 
 VERBOSE = False
 GRID_SIZE = 2.5
 
+# memory budget of the forward kinematics cache
+POSE_CACHE_BUDGET = 256 << 20
+
+# characters spawned by the crowd mode
+CROWD_SIZE = 500
+
 VIEWER_STATE = {
     'projection': True,
 
@@ -170,7 +39,25 @@ VIEWER_STATE = {
         'up': np.array([0., 1., 0.]),
     },
 
-    'bvh': None
+    'bvh': None,
+    'poses': None,
+    'stream': None,
+    'renderer': None,
+    'crowd': None,
+    'skin': None,
+
+    'playback': {
+        'playing': False,
+        'time': 0.,
+        'last_update': None
+    },
+
+    'load': {
+        'lock': threading.Lock(),
+        'generation': 0,
+        'pending': None,
+        'skin': None
+    }
 }
 
 
@@ -202,6 +89,57 @@ def draw_grid():
     glEnd()
 
 
+def current_frame():
+    bvh = VIEWER_STATE['bvh']
+    if bvh is None or bvh.num_of_frames == 0:
+        return 0
+
+    return int(VIEWER_STATE['playback']['time'] * bvh.fps) % bvh.num_of_frames
+
+
+def update_playback():
+    playback = VIEWER_STATE['playback']
+
+    now = glfw.get_time()
+    if playback['playing'] and playback['last_update'] is not None:
+        playback['time'] += now - playback['last_update']
+    playback['last_update'] = now
+
+    # while the file is still being read, wait at the last frame read so far
+    bvh = VIEWER_STATE['bvh']
+    if VIEWER_STATE['stream'] is not None and bvh.num_of_frames > 0:
+        playback['time'] = min(playback['time'], (bvh.num_of_frames - .5) / bvh.fps)
+
+
+def seek(num_of_frames):
+    bvh = VIEWER_STATE['bvh']
+    if bvh is None or bvh.num_of_frames == 0:
+        return
+
+    frame = (current_frame() + num_of_frames) % bvh.num_of_frames
+    VIEWER_STATE['playback']['time'] = (frame + .5) / bvh.fps
+
+
+def draw_skeleton(renderer, poses, frame):
+    # global joint positions are a lookup into the FK cache
+    renderer.update(poses[frame])
+
+    glColor3ub(255, 255, 255)
+    renderer.render()
+
+
+def draw_skin(skin, poses, frame):
+    skin.deform(poses[frame])
+
+    glEnable(GL_LIGHTING)
+    glEnable(GL_LIGHT0)
+    glEnable(GL_NORMALIZE)
+
+    skin.mesh.render()
+
+    glDisable(GL_LIGHTING)
+
+
 def process_camera():
     distance = VIEWER_STATE['cam']['distance']
     azimuth = VIEWER_STATE['cam']['azimuth']
@@ -230,8 +168,20 @@ def render():
 
     draw_grid()
 
-    if VIEWER_STATE['bvh'] is not None:
-        VIEWER_STATE['bvh'].render()
+    if VIEWER_STATE['crowd'] is not None:
+        VIEWER_STATE['crowd'].update(VIEWER_STATE['playback']['time'])
+
+        glColor3ub(255, 255, 255)
+        VIEWER_STATE['crowd'].render()
+    elif VIEWER_STATE['bvh'] is not None:
+        frame = current_frame()
+
+        if VIEWER_STATE['playback']['playing']:
+            VIEWER_STATE['poses'].prefetch(frame)
+        draw_skeleton(VIEWER_STATE['renderer'], VIEWER_STATE['poses'], frame)
+
+        if VIEWER_STATE['skin'] is not None:
+            draw_skin(VIEWER_STATE['skin'], VIEWER_STATE['poses'], frame)
 
 
 prev_cursor_xpos = 0
@@ -320,23 +270,174 @@ def key_callback(window, key, scancode, action, mods):
         VIEWER_STATE['projection'] = not VIEWER_STATE['projection']
         verbose('Changed VIEWER_STATE(projection) to',
                 VIEWER_STATE['projection'])
-        
+    elif key == glfw.KEY_SPACE and action == glfw.PRESS:
+        VIEWER_STATE['playback']['playing'] = not VIEWER_STATE['playback']['playing']
+    elif key == glfw.KEY_C and action == glfw.PRESS:
+        toggle_crowd()
+    elif action == glfw.PRESS or action == glfw.REPEAT:
+        if key == glfw.KEY_RIGHT:
+            seek(1)
+        elif key == glfw.KEY_LEFT:
+            seek(-1)
+        elif key == glfw.KEY_UP:
+            seek(10)
+        elif key == glfw.KEY_DOWN:
+            seek(-10)
+        elif key == glfw.KEY_HOME:
+            VIEWER_STATE['playback']['time'] = 0.
+
+
+def toggle_crowd():
+    if VIEWER_STATE['crowd'] is not None:
+        VIEWER_STATE['crowd'] = None
+    elif VIEWER_STATE['bvh'] is not None:
+        # instances of the current clip with random time offsets & headings,
+        # spread over the whole clip while it is still streaming in
+        stream = VIEWER_STATE['stream']
+        num_of_frames = None if stream is None else [stream.num_of_frames]
+        VIEWER_STATE['crowd'] = Crowd.grid([VIEWER_STATE['bvh']], CROWD_SIZE, num_of_frames=num_of_frames)
+        print('[Crowd] %d characters' % CROWD_SIZE, flush=True)
+
+
+def load_worker(generation, fnames):
+    fname = fnames[0]
+    crowd = None
 
-def drop_callback(window, cbfun):
-    fname = cbfun[0]
+    try:
+        # only the hierarchy is parsed here, the motion keeps streaming in
+        stream = BVHStream(fname)
+        bvh = stream.bvh
+
+        # several files make a crowd playing all of them
+        if len(fnames) > 1:
+            clips = [bvh] + [load_bvh(f) for f in fnames[1:]]
+            crowd = Crowd.grid(clips, CROWD_SIZE,
+                               num_of_frames=[stream.num_of_frames] + [c.num_of_frames for c in clips[1:]])
+
+        # forward kinematics runs lazily in blocks around the playhead; the
+        # first block is computed here, off the render loop
+        poses = PoseCache(bvh.skeleton, motion_or_rest_pose(bvh), budget=POSE_CACHE_BUDGET)
+        poses.block(0)
+    except Exception as e:
+        print('<Exception while loading %s>' % fname)
+        print(e)
+        return
+
+    # drop the result if a newer file was dropped meanwhile
+    with VIEWER_STATE['load']['lock']:
+        if generation == VIEWER_STATE['load']['generation']:
+            VIEWER_STATE['load']['pending'] = (fnames, stream, poses, crowd)
+            return
+
+    stream.close()
+    poses.close()
+
+
+def load_skin_worker(fname, skeleton):
+    try:
+        # the mesh is fitted to the rest pose and bound to the nearest bones
+        mesh = obj_mesh_loader().from_file(fname, force_smooth=True)
+        fit_to_skeleton(mesh, skeleton)
+        skin = Skin(mesh, skeleton)
+    except Exception as e:
+        print('<Exception while loading %s>' % fname)
+        print(e)
+        return
+
+    with VIEWER_STATE['load']['lock']:
+        VIEWER_STATE['load']['skin'] = skin
+
+
+def process_loaded_skin():
+    with VIEWER_STATE['load']['lock']:
+        skin = VIEWER_STATE['load']['skin']
+        VIEWER_STATE['load']['skin'] = None
+
+    # bound to a skeleton that was replaced meanwhile
+    if skin is None or VIEWER_STATE['bvh'] is None or skin.skeleton is not VIEWER_STATE['bvh'].skeleton:
+        return
+
+    VIEWER_STATE['skin'] = skin
+    print('[Skin] %d vertices, %d bones' % (len(skin), len(skin.joints)), flush=True)
+
+
+def process_loaded_bvh():
+    with VIEWER_STATE['load']['lock']:
+        pending = VIEWER_STATE['load']['pending']
+        VIEWER_STATE['load']['pending'] = None
 
-    with open(fname, 'rt') as f:
-        bvh = VIEWER_STATE['bvh'] = parse_bvh(f.readlines())
+    if pending is None:
+        return
+
+    fnames, stream, poses, crowd = pending
+    if VIEWER_STATE['poses'] is not None:
+        VIEWER_STATE['poses'].close()
+    if VIEWER_STATE['stream'] is not None:
+        VIEWER_STATE['stream'].close()
+
+    bvh = stream.bvh
+    VIEWER_STATE['bvh'] = bvh
+    VIEWER_STATE['poses'] = poses
+    VIEWER_STATE['stream'] = stream
+    VIEWER_STATE['renderer'] = SkeletonRenderer(bvh.skeleton)
+    VIEWER_STATE['crowd'] = crowd
+    VIEWER_STATE['skin'] = None
+    VIEWER_STATE['playback']['time'] = 0.
 
     print('[Open BVH]')
-    print('File name:', fname)
-    print('Num of frames:', bvh.num_of_frames)
+    print('File name:', ', '.join(fnames))
+    print('Num of frames:', stream.num_of_frames)
     print('FPS:', bvh.fps)
     print('Num of joints:', len(bvh.joints))
     print('Joint list:', ', '.join(bvh.joints))
+    if crowd is not None:
+        print('Crowd: %d characters from %d clips' % (len(crowd), len(crowd.clips)))
     print(flush=True)
 
 
+def process_stream():
+    stream = VIEWER_STATE['stream']
+    if stream is None:
+        return
+
+    # read done before taking the frames so the last chunk is not missed
+    done = stream.done
+
+    bvh = VIEWER_STATE['bvh']
+    if stream.available() > bvh.num_of_frames:
+        motion = stream.motion()
+        bvh.set_motion(motion)
+        VIEWER_STATE['poses'].set_motion(motion)
+
+    if done:
+        VIEWER_STATE['stream'] = None
+
+        if stream.error is not None:
+            print('<Exception while reading %s>' % stream.filename)
+            print(stream.error)
+        elif bvh.num_of_frames != stream.num_of_frames:
+            print('Read %d of %d frames of %s' % (bvh.num_of_frames, stream.num_of_frames, stream.filename))
+
+
+def drop_callback(window, cbfun):
+    fnames = list(cbfun)
+
+    # an OBJ mesh is skinned to the current skeleton
+    if fnames[0].lower().endswith('.obj'):
+        if VIEWER_STATE['bvh'] is not None:
+            threading.Thread(target=load_skin_worker, args=(fnames[0], VIEWER_STATE['bvh'].skeleton),
+                             daemon=True).start()
+        return
+
+    # parse in the background while the previous motion keeps rendering
+    with VIEWER_STATE['load']['lock']:
+        VIEWER_STATE['load']['generation'] += 1
+        VIEWER_STATE['load']['pending'] = None
+        generation = VIEWER_STATE['load']['generation']
+
+    threading.Thread(target=load_worker, args=(generation, fnames), daemon=True).start()
+
+
 def main():
     # Initialize GLFW
     if not glfw.init():
@@ -360,6 +461,10 @@ def main():
     while not glfw.window_should_close(window):
         glfw.poll_events()
 
+        process_loaded_bvh()
+        process_loaded_skin()
+        process_stream()
+        update_playback()
         render()
 
         glfw.swap_buffers(window)
@@ -0,0 +1,293 @@
+import time
+
+import numpy as np
+
+from bvh import BVH
+from kinematics import joint_positions, root_motion
+
+# future frames sampled for the root trajectory features
+TRAJECTORY_OFFSETS = (20, 40, 60)
+
+# leaves scanned first to tighten the k-th best distance of a query
+FIRST_LEAVES = 16
+
+
+def to_local(v, facing):
+    # world (..., N, 3) or (..., N, 2) xz vectors -> the frame of a root
+    # facing (N, 2); x to the side, z forward
+    fx, fz = facing[:, 0], facing[:, 1]
+    x, z = v[..., 0], v[..., -1]
+
+    local = v.copy()
+    local[..., 0] = fz * x - fx * z
+    local[..., -1] = fx * x + fz * z
+
+    return local
+
+
+def clip_features(bvh, joints):
+    # raw (F, D) features of every frame of a clip:
+    # joint positions relative to the root, joint velocities, future root
+    # positions & facing directions, all in the root's frame
+    skeleton = bvh.skeleton
+    motion = bvh.motion
+    F = len(motion)
+
+    root, facing = root_motion(skeleton, motion)
+
+    positions = joint_positions(skeleton, motion)[:, joints]
+
+    velocities = np.empty_like(positions)
+    velocities[1:] = (positions[1:] - positions[:-1]) * bvh.fps
+    velocities[:1] = velocities[1:2] if F > 1 else 0.
+
+    relative = positions - root[:, None]
+
+    # future samples are clamped to the end of the clip
+    future = np.minimum(np.arange(F)[:, None] + np.array(TRAJECTORY_OFFSETS), F - 1)
+    trajectory = (root[future] - root[:, None])[..., [0, 2]]
+    directions = facing[future]
+
+    groups = [to_local(np.swapaxes(g, 0, 1), facing) for g in [relative, velocities, trajectory, directions]]
+    return [np.swapaxes(g, 0, 1).reshape(F, -1) for g in groups]
+
+
+def end_effectors(skeleton):
+    # joints whose only children are end sites, e.g. hands, feet and head
+    parents = skeleton.parents[skeleton.is_end]
+    return np.unique(parents[parents >= 0])
+
+
+class FeatureDatabase:
+    # Normalized pose features of every frame of a set of clips. Each
+    # feature group (positions, velocities, trajectory positions and
+    # directions) is scaled to unit standard deviation and then weighted.
+    def __init__(self, clips, joints=None, weights=(1., 1., 1., 1.)):
+        self.clips = clips
+
+        if joints is None:
+            joints = end_effectors(clips[0].skeleton)
+        self.joints = np.asarray(joints)
+
+        groups = [clip_features(bvh, self.joints) for bvh in clips]
+        groups = [np.concatenate(g) for g in zip(*groups)]
+
+        self.mean = [g.mean(axis=0) for g in groups]
+        self.scale = [g.std(axis=0).mean() / w if g.size else 1. for g, w in zip(groups, weights)]
+        self.scale = [s if s > 0 else 1. for s in self.scale]
+
+        self.features = np.ascontiguousarray(np.concatenate(
+            [(g - m) / s for g, m, s in zip(groups, self.mean, self.scale)], axis=1), dtype=np.float32)
+
+        # which clip & frame every row came from
+        lengths = [bvh.num_of_frames for bvh in clips]
+        self.clip_index = np.repeat(np.arange(len(clips)), lengths)
+        self.frame_index = np.concatenate([np.arange(n) for n in lengths])
+
+    def __len__(self):
+        return len(self.features)
+
+    def normalize(self, groups):
+        # raw feature groups, as from clip_features -> normalized rows
+        return np.concatenate([(g - m) / s for g, m, s in zip(groups, self.mean, self.scale)], axis=-1)
+
+
+def box_distances(q, lo, hi):
+    # squared distances from q (D,) to the axis aligned boxes (N, D)
+    d = np.maximum(lo - q, 0) + np.maximum(q - hi, 0)
+    return np.einsum('nd,nd->n', d, d)
+
+
+def kd_order(features, leaf_size, sample=256, seed=0):
+    # row order of a k-d tree: every range is split at a median along its
+    # widest dimension (estimated on a sample), the left part holding a
+    # power of two leaves so aligned groups of leaves are whole subtrees
+    rng = np.random.default_rng(seed)
+    order = np.arange(len(features))
+    ranges = [(0, len(features))]
+
+    while ranges:
+        a, b = ranges.pop()
+        num_of_leaves = -(-(b - a) // leaf_size)
+        if num_of_leaves <= 1:
+            continue
+
+        picks = order[a:b] if b - a <= sample else order[a + rng.choice(b - a, sample, replace=False)]
+        dim = np.argmax(np.ptp(features[picks], axis=0))
+
+        mid = a + leaf_size * (1 << (int(num_of_leaves - 1).bit_length() - 1))
+        part = np.argpartition(features[order[a:b], dim], mid - a - 1)
+        order[a:b] = order[a:b][part]
+
+        ranges.append((a, mid))
+        ranges.append((mid, b))
+
+    return order
+
+
+class PoseIndex:
+    # k-nearest-neighbour search over feature rows. The rows are ordered
+    # like the leaves of a k-d tree, leaves are grouped into nodes and both
+    # get bounding boxes; a query scans only the rows of leaves whose box
+    # can still beat the k-th best distance found in the nearest node.
+    def __init__(self, features, leaf_size=32, node_size=16):
+        self.leaf_size = leaf_size
+        self.node_size = node_size
+
+        self.order = kd_order(features, leaf_size)
+        self.features = np.ascontiguousarray(features[self.order], dtype=np.float32)
+
+        self.leaf_lo, self.leaf_hi = self._boxes(self.features, self.features, leaf_size)
+        self.node_lo, self.node_hi = self._boxes(self.leaf_lo, self.leaf_hi, node_size)
+
+        self.sq_norms = np.einsum('nd,nd->n', self.features, self.features)
+
+    @staticmethod
+    def _boxes(lo, hi, size):
+        starts = np.arange(0, len(lo), size)
+        return np.minimum.reduceat(lo, starts), np.maximum.reduceat(hi, starts)
+
+    def __len__(self):
+        return len(self.features)
+
+    def query(self, q, k=1):
+        # -> (k,) squared distances and feature row indices, nearest first
+        q = np.asarray(q, dtype=np.float32)
+        k = min(k, len(self.features))
+
+        node_lb = box_distances(q, self.node_lo, self.node_hi)
+
+        # the nearest node gives a first k-th best distance ...
+        nearest = np.argmin(node_lb)
+        d = self._distances(q, self._node_rows(nearest))
+        worst = np.partition(d, k - 1)[k - 1] if len(d) >= k else np.inf
+
+        # ... the most promising leaves of the nodes that can still beat it
+        # tighten it further ...
+        nodes = np.flatnonzero(node_lb <= worst)
+        leaves = (nodes[:, None] * self.node_size + np.arange(self.node_size)).ravel()
+        leaves = leaves[leaves < len(self.leaf_lo)]
+        leaf_lb = box_distances(q, self.leaf_lo[leaves], self.leaf_hi[leaves])
+
+        # (the nearest node's rows are in d already)
+        first = np.argsort(leaf_lb)[:FIRST_LEAVES]
+        first = first[leaves[first] // self.node_size != nearest]
+        d = np.concatenate([d, self._distances(q, self._leaf_rows(leaves[first]))])
+        worst = min(worst, np.partition(d, k - 1)[k - 1]) if len(d) >= k else worst
+
+        # ... and every leaf and row that can still beat that is gathered and
+        # scanned in one go
+        leaves = leaves[leaf_lb <= worst]
+        rows = self._leaf_rows(leaves)
+        d = self._distances(q, rows)
+
+        best = np.argpartition(d, k - 1)[:k] if len(d) > k else np.arange(len(d))
+        best = best[np.argsort(d[best])]
+        return d[best], self.order[rows[best]]
+
+    def _leaf_rows(self, leaves):
+        rows = (leaves[:, None] * self.leaf_size + np.arange(self.leaf_size)).ravel()
+        return rows[rows < len(self.features)]
+
+    def _node_rows(self, node):
+        first = node * self.node_size * self.leaf_size
+        return np.arange(first, min(first + self.node_size * self.leaf_size, len(self.features)))
+
+    def _distances(self, q, rows):
+        d = self.features[rows] - q
+        return np.einsum('nd,nd->n', d, d)
+
+    def query_many(self, Q, k=1, block=1 << 16):
+        # brute force for a batch of queries (M, D): |x|^2 - 2 x.q + |q|^2
+        # one BLAS matrix product per block of rows -> (M, k), (M, k)
+        Q = np.asarray(Q, dtype=np.float32)
+        q_norms = np.einsum('md,md->m', Q, Q)
+
+        best_d = np.full((len(Q), k), np.inf, dtype=np.float32)
+        best_i = np.zeros((len(Q), k), dtype=np.int64)
+
+        for start in range(0, len(self.features), block):
+            rows = self.features[start:start + block]
+            d = self.sq_norms[start:start + block] - 2 * (Q @ rows.T) + q_norms[:, None]
+
+            kk = min(k, d.shape[1])
+            idx = np.argpartition(d, kk - 1, axis=1)[:, :kk]
+
+            cand_d = np.concatenate([best_d, np.take_along_axis(d, idx, axis=1)], axis=1)
+            cand_i = np.concatenate([best_i, idx + start], axis=1)
+
+            keep = np.argsort(cand_d, axis=1)[:, :k]
+            best_d = np.take_along_axis(cand_d, keep, axis=1)
+            best_i = np.take_along_axis(cand_i, keep, axis=1)
+
+        return np.maximum(best_d, 0), self.order[best_i]
+
+
+def synthetic_clips(bvh, num_of_clips, num_of_frames, seed=0):
+    # variations of a clip: random start, playback speed, heading and slowly
+    # drifting joint angles
+    rng = np.random.default_rng(seed)
+    header = bvh.header()
+    clips = []
+
+    for _ in range(num_of_clips):
+        speed = rng.uniform(.7, 1.4)
+        t = (rng.uniform(0, bvh.num_of_frames) + np.arange(num_of_frames) * speed) % (bvh.num_of_frames - 1)
+        i = t.astype(np.int64)
+        w = (t - i)[:, None]
+        motion = bvh.motion[i] * (1 - w) + bvh.motion[i + 1] * w
+
+        # smooth offsets: random keys every second, blended linearly
+        keys = rng.normal(0, 3., (num_of_frames // 30 + 2, motion.shape[1]))
+        k = np.arange(num_of_frames) / 30
+        i = k.astype(np.int64)
+        w = (k - i)[:, None]
+        motion = motion + keys[i] * (1 - w) + keys[i + 1] * w
+
+        clips.append(BVH.from_header(header, motion))
+
+    return clips
+
+
+if __name__ == '__main__':
+    import sys
+    from bvh import load_bvh
+
+    bvh = load_bvh(sys.argv[1])
+    num_of_clips = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    num_of_frames = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+
+    clips = synthetic_clips(bvh, num_of_clips, num_of_frames)
+
+    start = time.perf_counter()
+    db = FeatureDatabase(clips)
+    print('Features: %d frames x %d dims in %.2f s' % (len(db), db.features.shape[1], time.perf_counter() - start))
+
+    start = time.perf_counter()
+    index = PoseIndex(db.features)
+    print('Index: %.3f s' % (time.perf_counter() - start))
+
+    # queries are database poses with a little noise, like a running
+    # character's current pose
+    rng = np.random.default_rng(1)
+    queries = db.features[rng.integers(len(db), size=200)]
+    queries = queries + rng.normal(0, .1, queries.shape).astype(np.float32)
+
+    for k in (1, 5):
+        times = []
+        results = []
+        for q in queries:
+            start = time.perf_counter()
+            results.append(index.query(q, k)[1])
+            times.append(time.perf_counter() - start)
+        times = np.array(times) * 1e3
+        print('Pruned k-NN (k=%d): mean %.3f ms, p50 %.3f ms, p99 %.3f ms' % (
+            k, times.mean(), np.percentile(times, 50), np.percentile(times, 99)))
+
+        start = time.perf_counter()
+        _, brute = index.query_many(queries, k)
+        print('Blocked BLAS k-NN (k=%d): %.3f ms per query in a batch of %d' % (
+            k, (time.perf_counter() - start) * 1e3 / len(queries), len(queries)))
+
+        agree = np.mean([set(a) == set(b) for a, b in zip(results, brute)])
+        print('Same neighbours: %.1f%%' % (agree * 100))
@@ -0,0 +1,55 @@
+import numpy as np
+
+from OpenGL.GL import *
+from OpenGL.arrays import vbo
+
+
+class LineBuffer:
+    # GL_LINES vertices kept in one dynamic VBO: one buffer update and one
+    # draw call per frame
+    def __init__(self):
+        self.vertices = np.zeros((0, 3), dtype=np.float32)
+        self.vbo = None
+
+    def set_vertices(self, vertices):
+        self.vertices = vertices
+
+        if self.vbo is not None:
+            self.vbo.set_array(self.vertices)
+
+    def render(self):
+        if len(self.vertices) == 0:
+            return
+
+        if self.vbo is None:
+            self.vbo = vbo.VBO(self.vertices, usage='GL_DYNAMIC_DRAW')
+
+        glEnableClientState(GL_VERTEX_ARRAY)
+
+        self.vbo.bind()
+        glVertexPointer(3, GL_FLOAT, 0, self.vbo)
+        glDrawArrays(GL_LINES, 0, len(self.vertices))
+        self.vbo.unbind()
+
+        glDisableClientState(GL_VERTEX_ARRAY)
+
+
+class SkeletonRenderer(LineBuffer):
+    # Draws the bones of one or more poses of a skeleton as a single
+    # GL_LINES batch.
+    def __init__(self, skeleton):
+        super().__init__()
+        self.skeleton = skeleton
+
+        # (parent, child) joint index pairs, one line segment per bone
+        joints = np.arange(1, len(skeleton))
+        self.segments = np.stack([skeleton.parents[1:], joints], axis=1).ravel()
+
+    def lines(self, positions):
+        # positions: (..., J, 3) global joint positions, every leading index
+        # is one skeleton in the batch -> (bones * 2, 3) float32
+        return positions[..., self.segments, :].astype(np.float32).reshape(-1, 3)
+
+    def update(self, transforms):
+        # transforms: (..., J, 4, 4) global joint transforms
+        self.set_vertices(self.lines(transforms[..., :3, 3]))
@@ -0,0 +1,97 @@
+import numpy as np
+
+from bvh import BVH
+from kinematics import channel_groups, euler_to_quaternions, quaternions_to_euler, slerp
+
+# output frames converted at a time, bounds the temporary quaternion arrays
+RESAMPLE_BLOCK = 16384
+
+
+def sample_points(num_of_frames, src_fps, dst_fps):
+    # source frame pairs & blend weights of every output frame
+    num_of_samples = int(np.floor((num_of_frames - 1) * dst_fps / src_fps + 1e-6)) + 1
+
+    src = np.arange(num_of_samples) * (src_fps / dst_fps)
+    i0 = np.minimum(np.floor(src).astype(np.int64), max(num_of_frames - 2, 0))
+    i1 = np.minimum(i0 + 1, num_of_frames - 1)
+
+    return i0, i1, src - i0
+
+
+def column_runs(cols):
+    # sorted column indices -> [(first, last + 1, position in cols)] of
+    # their contiguous runs, assigning slices is much faster than fancy
+    # indexing along the second axis
+    breaks = np.flatnonzero(np.diff(cols) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(cols)]])
+
+    return [(cols[a], cols[b - 1] + 1, a) for a, b in zip(starts, stops)]
+
+
+def assign_columns(out, cols, values):
+    # out[:, cols] = values
+    order = np.argsort(cols, kind='stable')
+    cols = cols[order]
+
+    if np.array_equal(order, np.arange(len(cols))):
+        for first, last, pos in column_runs(cols):
+            out[:, first:last] = values[:, pos:pos + last - first]
+    else:
+        out[:, cols] = values[:, order]
+
+
+def resample(bvh, fps):
+    # the same motion sampled at fps: rotations are slerped as quaternions,
+    # every other channel (root position, ...) is linearly interpolated
+    header = bvh.header()
+    header['fps'] = fps
+
+    if bvh.num_of_frames == 0:
+        return BVH.from_header(header, bvh.motion.copy())
+
+    motion = bvh.motion
+    i0, i1, w = sample_points(bvh.num_of_frames, bvh.fps, fps)
+
+    out = np.empty((len(w), motion.shape[1]))
+
+    # samples falling on a source frame are exact already, e.g. every
+    # sample when halving the frame rate
+    blend = np.flatnonzero((w > 1e-9) & (w < 1 - 1e-9))
+    nearest = np.where(w < .5, i0, i1)
+
+    slerped = np.zeros(motion.shape[1], dtype=bool)
+
+    for order, (joints, columns) in channel_groups(bvh.skeleton).items():
+        # single axis or repeated axis orders keep the linear blend
+        if len(order) != 3 or len(set(order)) != 3:
+            continue
+
+        # (frames, joints, 3) contiguous copy of the group's channels
+        cols = columns.ravel()
+        angles = motion[:, cols].reshape(len(motion), len(joints), 3)
+        result = angles[nearest]
+
+        for start in range(0, len(blend), RESAMPLE_BLOCK):
+            samples = blend[start:start + RESAMPLE_BLOCK]
+
+            # only the source frames this block blends are converted
+            frames, inverse = np.unique(np.concatenate([i0[samples], i1[samples]]), return_inverse=True)
+            q = euler_to_quaternions(angles[frames], order)
+
+            q = slerp(q[inverse[:len(samples)]], q[inverse[len(samples):]], w[samples, None])
+            e = quaternions_to_euler(q, order)
+
+            # wrap like the nearest source frame instead of at +-180
+            ref = result[samples]
+            result[samples] = e + 360. * np.round((ref - e) / 360.)
+
+        assign_columns(out, cols, result.reshape(len(w), -1))
+        slerped[cols] = True
+
+    # everything else (root position, ...) is blended linearly
+    cols = np.flatnonzero(~slerped)
+    rest = motion[:, cols]
+    assign_columns(out, cols, rest[i0] * (1 - w[:, None]) + rest[i1] * w[:, None])
+
+    return BVH.from_header(header, out)
@@ -0,0 +1,222 @@
+import os
+import sys
+
+import numpy as np
+
+from kinematics import forward_kinematics, rest_positions, rest_transforms, skeleton_size
+
+# class02 has the OBJ mesh loader
+CLASS02_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'class02')
+
+# bones influencing a vertex
+MAX_INFLUENCES = 4
+
+# vertices whose bone distances are computed at a time while binding
+BIND_BLOCK = 16384
+
+
+def obj_mesh_loader():
+    if CLASS02_DIR not in sys.path:
+        sys.path.append(CLASS02_DIR)
+    from mesh import ObjMeshLoader
+
+    return ObjMeshLoader
+
+
+def bone_segments(skeleton, rest):
+    # (B,) joint driving every bone and (B, 2, 3) its rest pose end points;
+    # a bone runs from a joint to one of its children, joints without
+    # children get a point bone
+    children = np.arange(1, len(skeleton))
+    owners = skeleton.parents[children]
+
+    lonely = np.setdiff1d(np.flatnonzero(~skeleton.is_end), owners)
+    owners = np.concatenate([owners, lonely])
+    ends = np.concatenate([children, lonely])
+
+    p = rest[:, :3, 3]
+    return owners, np.stack([p[owners], p[ends]], axis=1)
+
+
+def segment_distances(points, segments):
+    # (V, 3) points, (B, 2, 3) segments -> (V, B) distances
+    a, b = segments[:, 0], segments[:, 1]
+    ab = b - a
+    length2 = np.maximum(np.einsum('bi,bi->b', ab, ab), 1e-12)
+
+    ap = points[:, None] - a
+    t = np.clip(np.einsum('vbi,bi->vb', ap, ab) / length2, 0., 1.)
+
+    return np.linalg.norm(ap - t[..., None] * ab, axis=-1)
+
+
+def nearest_bone_weights(points, skeleton, rest, max_influences=MAX_INFLUENCES):
+    # (V, K) joint indices & (V, K) weights of the K nearest bones, the
+    # weights fall off with the squared distance and sum to one
+    owners, segments = bone_segments(skeleton, rest)
+
+    # distance to a joint is the distance to the nearest of its bones
+    joints, owner_index = np.unique(owners, return_inverse=True)
+    k = min(max_influences, len(joints))
+
+    indices = np.empty((len(points), k), dtype=np.int64)
+    weights = np.empty((len(points), k), dtype=np.float32)
+
+    for start in range(0, len(points), BIND_BLOCK):
+        d = segment_distances(points[start:start + BIND_BLOCK], segments)
+
+        per_joint = np.full((len(d), len(joints)), np.inf)
+        np.minimum.at(per_joint.T, owner_index, d.T)
+
+        nearest = np.argpartition(per_joint, k - 1, axis=1)[:, :k]
+        w = 1 / np.maximum(np.take_along_axis(per_joint, nearest, axis=1), 1e-6) ** 2
+
+        indices[start:start + BIND_BLOCK] = joints[nearest]
+        weights[start:start + BIND_BLOCK] = w / w.sum(axis=1, keepdims=True)
+
+    return indices, weights
+
+
+def writable_vertices(mesh):
+    # a mesh from the class02 cache has its interleaved vertices in a
+    # read-only memory map, fitting & deforming work on a private copy
+    if not mesh.varr.flags.writeable:
+        mesh.varr = np.array(mesh.varr)
+        if mesh.vbo is not None:
+            mesh.vbo.set_array(mesh.varr)
+
+    return mesh.varr
+
+
+def fit_to_skeleton(mesh, skeleton):
+    # scale & move a built mesh so its bounding box has the height of the
+    # rest pose, stands on the same ground and is centered on it
+    rest = rest_positions(skeleton)
+    positions = writable_vertices(mesh)[:, 3:6]
+
+    lo, hi = positions.min(axis=0), positions.max(axis=0)
+    rest_lo, rest_hi = rest.min(axis=0), rest.max(axis=0)
+
+    scale = (rest_hi[1] - rest_lo[1]) / max(hi[1] - lo[1], 1e-12)
+    offset = (rest_lo + rest_hi) / 2 - (lo + hi) / 2 * scale
+    offset[1] = rest_lo[1] - lo[1] * scale
+
+    positions *= scale
+    positions += offset.astype(np.float32)
+
+
+class Skin:
+    # Linear blend skinning of a built class02 Mesh by a BVH skeleton. The
+    # mesh is bound in the skeleton's rest pose; every deform() blends the
+    # (J, 4, 4) palette of global transforms times inverse bind transforms
+    # for all vertices at once and streams the interleaved (normal,
+    # position) array into the mesh's dynamic VBO.
+    def __init__(self, mesh, skeleton, max_influences=MAX_INFLUENCES):
+        self.mesh = mesh
+        self.skeleton = skeleton
+        writable_vertices(mesh)
+
+        rest = rest_transforms(skeleton)
+        self.inverse_bind = np.linalg.inv(rest)
+
+        # bind pose normals & positions of the mesh's vertices
+        self.normals = mesh.varr[:, :3].astype(np.float32)
+        self.positions = mesh.varr[:, 3:6].astype(np.float32)
+
+        self.indices, self.weights = nearest_bone_weights(mesh.varr[:, 3:6], skeleton, rest, max_influences)
+
+        # only joints driving a vertex take part in the palette
+        self.joints, inverse = np.unique(self.indices, return_inverse=True)
+        self.palette_index = inverse.reshape(self.indices.shape)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def palette(self, transforms):
+        # (J, 4, 4) global transforms -> (P, 12) flattened 3 x 4 skinning
+        # matrices of the joints in use
+        M = transforms[self.joints] @ self.inverse_bind[self.joints]
+        return M[:, :3].reshape(-1, 12).astype(np.float32)
+
+    def deform(self, transforms):
+        # one blended 3 x 4 matrix per vertex: (V, K) weights times the
+        # gathered (V, K, 12) palette entries, then applied to the bind
+        # pose positions and normals
+        M = np.take(self.palette(transforms), self.palette_index, axis=0)
+        M = np.einsum('vk,vkj->vj', self.weights, M).reshape(-1, 3, 4)
+
+        varr = self.mesh.varr
+        np.einsum('vij,vj->vi', M[..., :3], self.positions, out=varr[:, 3:6])
+        varr[:, 3:6] += M[..., 3]
+        np.einsum('vij,vj->vi', M[..., :3], self.normals, out=varr[:, :3])
+
+        if self.mesh.vbo is not None:
+            self.mesh.vbo.set_array(varr)
+
+
+def tube_mesh(skeleton, rings=100, sides=48, radius=None):
+    # OBJ text of a tube around every bone of the rest pose, a stand-in
+    # character with rings * sides vertices per bone
+    rest = rest_transforms(skeleton)
+    _, segments = bone_segments(skeleton, rest)
+    if radius is None:
+        radius = .02 * skeleton_size(skeleton)
+
+    lines = []
+    base = 0
+    for a, b in segments:
+        axis = b - a
+        length = np.linalg.norm(axis)
+        if length < 1e-6:
+            continue
+        axis /= length
+
+        u = np.cross(axis, [0., 0., 1.] if abs(axis[2]) < .9 else [1., 0., 0.])
+        u /= np.linalg.norm(u)
+        v = np.cross(axis, u)
+
+        t = np.linspace(0, 1, rings)[:, None, None]
+        th = np.linspace(0, 2 * np.pi, sides, endpoint=False)[None, :, None]
+        points = (a + t * (b - a) + radius * (np.cos(th) * u + np.sin(th) * v)).reshape(-1, 3)
+        lines.extend('v %f %f %f' % tuple(p) for p in points)
+
+        r, s = np.arange(rings - 1)[:, None], np.arange(sides)[None]
+        i0 = base + r * sides + s + 1
+        i1 = base + r * sides + (s + 1) % sides + 1
+        quads = np.stack([i0, i1, i1 + sides, i0 + sides], axis=-1).reshape(-1, 4)
+        lines.extend('f %d %d %d %d' % tuple(q) for q in quads)
+
+        base += len(points)
+
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    import time
+    from bvh import load_bvh
+
+    bvh = load_bvh(sys.argv[1])
+
+    if len(sys.argv) > 2:
+        mesh = obj_mesh_loader().from_file(sys.argv[2], force_smooth=True)
+        fit_to_skeleton(mesh, bvh.skeleton)
+    else:
+        # 4800 vertices per bone, about 90k for the sample skeletons
+        mesh = obj_mesh_loader().load(tube_mesh(bvh.skeleton), force_smooth=True)
+
+    start = time.perf_counter()
+    skin = Skin(mesh, bvh.skeleton)
+    print('%d vertices, %d bones in the palette, bound in %.3f s' % (
+        len(skin), len(skin.joints), time.perf_counter() - start))
+
+    G = forward_kinematics(bvh.skeleton, bvh.motion)
+
+    times = []
+    for i in range(200):
+        start = time.perf_counter()
+        skin.deform(G[i % len(G)])
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1e3
+
+    print('Deform: mean %.2f ms, p50 %.2f ms, p99 %.2f ms (%.0f%% of a 60 fps frame)' % (
+        times.mean(), np.percentile(times, 50), np.percentile(times, 99), times.mean() / (1e3 / 60) * 100))
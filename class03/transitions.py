@@ -0,0 +1,293 @@
+import argparse
+import csv
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# no OpenGL / GLFW imports here, this runs on headless machines
+from analyze import find_files, output_format, write_output
+from bvh import load_bvh
+from kinematics import joint_positions, root_motion, skeleton_size
+from motionmatch import to_local
+
+# frames around a pose that are part of its point cloud, so that poses
+# moving in different directions are far apart
+WINDOW_OFFSETS = (-3, 0, 3)
+
+# rows & columns of the distance matrix computed at a time, a float32
+# block is 16 MB
+TRANSITION_BLOCK = 2048
+
+# the float32 distance blocks only prefilter the minima: their
+# cancellation error stays below this much of the squared norms, pairs
+# that close to the threshold or to a minimum are kept and their exact
+# distances decide
+PREFILTER_SLACK = 1e-5
+
+# candidate pairs whose float64 distances are computed at a time
+EXACT_BLOCK = 16384
+
+# default largest RMS distance of the point clouds, relative to the
+# skeleton size
+THRESHOLD_RATIO = .05
+
+# frames of the same clip closer than this are not transitions
+MIN_FRAME_GAP = 30
+
+# worker process state: features, clip boundaries, search parameters
+WORKER_STATE = {}
+
+
+def pose_clouds(bvh):
+    # (F, D) float32 point cloud of every frame: all joints over the window
+    # frames, in the frame of the root's current position & facing. The
+    # squared distance of two rows is the mean squared point distance.
+    skeleton = bvh.skeleton
+    motion = bvh.motion
+    F = len(motion)
+
+    root, facing = root_motion(skeleton, motion)
+
+    positions = joint_positions(skeleton, motion)
+
+    frames = np.clip(np.arange(F)[:, None] + np.array(WINDOW_OFFSETS), 0, F - 1)
+    cloud = positions[frames] - root[:, None, None] * [1., 0., 1.]
+    cloud = to_local(np.moveaxis(cloud.reshape(F, -1, 3), 0, -2), facing)
+
+    scale = 1 / np.sqrt(cloud.shape[0])
+    return np.ascontiguousarray(np.moveaxis(cloud, -2, 0).reshape(F, -1) * scale, dtype=np.float32)
+
+
+def init_worker(features_path, clip_index, threshold, min_gap, block):
+    # features are memory-mapped, every worker shares the same pages
+    features = np.load(features_path, mmap_mode='r')
+
+    WORKER_STATE['features'] = features
+    WORKER_STATE['sq_norms'] = np.einsum('nd,nd->n', features, features)
+    WORKER_STATE['clip_index'] = clip_index
+    WORKER_STATE['threshold'] = threshold
+    WORKER_STATE['min_gap'] = min_gap
+    WORKER_STATE['block'] = block
+
+
+def distance_block(rows, cols):
+    # squared distances of the feature rows & columns, in place
+    features, sq_norms = WORKER_STATE['features'], WORKER_STATE['sq_norms']
+
+    D = features[rows] @ features[cols].T
+    D *= -2
+    D += sq_norms[rows, None]
+    D += sq_norms[cols]
+
+    return D
+
+
+def exact_distances(i, j):
+    # (N,) float64 squared distances of the feature pairs (i, j)
+    features = WORKER_STATE['features']
+    d = np.empty(len(i))
+
+    for start in range(0, len(i), EXACT_BLOCK):
+        diff = features[i[start:start + EXACT_BLOCK]].astype(np.float64) - features[j[start:start + EXACT_BLOCK]]
+        d[start:start + EXACT_BLOCK] = np.einsum('nd,nd->n', diff, diff)
+
+    return d
+
+
+def neighbours(i, j):
+    # offsets (di, dj) of the 8 neighbours of the pairs (i, j) and whether
+    # each neighbour exists in the same clips
+    clip_index = WORKER_STATE['clip_index']
+    N = len(clip_index)
+
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            if di == 0 and dj == 0:
+                continue
+
+            ni, nj = i + di, j + dj
+            valid = (ni >= 0) & (ni < N) & (nj >= 0) & (nj < N)
+            valid[valid] &= (clip_index[ni[valid]] == clip_index[i[valid]]) & \
+                            (clip_index[nj[valid]] == clip_index[j[valid]])
+
+            yield di, dj, valid
+
+
+def block_minima(start):
+    # local minima (i, j, squared distance) below the threshold with
+    # start <= i < start + block and i < j. A block is computed with a one
+    # frame halo, its float32 distances within the slack of being a minimum
+    # are candidates and the exact distances of a candidate & its 8
+    # neighbours decide; neighbours in another clip do not count.
+    clip_index, sq_norms = WORKER_STATE['clip_index'], WORKER_STATE['sq_norms']
+    min_gap = WORKER_STATE['min_gap']
+    block = WORKER_STATE['block']
+    threshold = WORKER_STATE['threshold'] ** 2
+    N = len(clip_index)
+
+    stop = min(start + block, N)
+    rows = np.arange(max(start - 1, 0), min(stop + 1, N))
+
+    found = []
+    for first in range(start, N, block):
+        cols = np.arange(max(first - 1, 0), min(first + block + 1, N))
+        D = distance_block(rows, cols)
+        slack = PREFILTER_SLACK * (sq_norms[rows].max() + sq_norms[cols].max())
+
+        # candidates inside the block (not the halo) close to the threshold
+        r, c = np.nonzero(D < threshold + slack)
+        i, j = rows[r], cols[c]
+        keep = (i >= start) & (i < stop) & (j >= first) & (j < first + block) & (j > i)
+        keep &= (clip_index[i] != clip_index[j]) | (j - i >= min_gap)
+        r, c, i, j = r[keep], c[keep], i[keep], j[keep]
+
+        # candidates within the slack of a minimum, neighbours clearly above
+        # a candidate need no exact distance
+        d = D[r, c]
+        keep = np.ones(len(d), dtype=bool)
+        close = []
+        for di, dj, valid in neighbours(i, j):
+            nd = D[np.clip(r + di, 0, len(rows) - 1), np.clip(c + dj, 0, len(cols) - 1)]
+            keep &= ~valid | (d <= nd + 2 * slack)
+            close.append((di, dj, valid & (nd <= d + 2 * slack)))
+        i, j = i[keep], j[keep]
+
+        d = exact_distances(i, j)
+        minimum = d < threshold
+        for di, dj, valid in close:
+            valid = valid[keep] & minimum
+            minimum[valid] &= d[valid] <= exact_distances(i[valid] + di, j[valid] + dj)
+
+        found.append((i[minimum], j[minimum], d[minimum]))
+
+    return tuple(np.concatenate(a) for a in zip(*found))
+
+
+def find_transitions(features, clip_index, threshold, min_gap=MIN_FRAME_GAP, block=TRANSITION_BLOCK,
+                     jobs=1, progress=None):
+    # (i, j, distance) of every local minimum of the pose distance matrix
+    # below threshold, i < j; row blocks are spread over jobs processes
+    starts = range(0, len(features), block)
+    found = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'features.npy')
+        np.save(path, features)
+        args = (path, clip_index, threshold, min_gap, block)
+
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=args) as executor:
+                for n, result in enumerate(executor.map(block_minima, starts), 1):
+                    found.append(result)
+                    if progress is not None:
+                        progress(n, len(starts))
+        else:
+            init_worker(*args)
+            for n, start in enumerate(starts, 1):
+                found.append(block_minima(start))
+                if progress is not None:
+                    progress(n, len(starts))
+            WORKER_STATE.clear()
+
+    i, j, d = (np.concatenate(a) for a in zip(*found))
+    return i, j, np.sqrt(np.maximum(d, 0))
+
+
+def alignments(root, facing, src, dst):
+    # rotation about +Y (degrees) and xz translation placing frame dst
+    # where frame src is, so playback continues from src into dst
+    yaw = np.arctan2(facing[src, 0], facing[src, 1]) - np.arctan2(facing[dst, 0], facing[dst, 1])
+    c, s = np.cos(yaw), np.sin(yaw)
+
+    x, z = root[dst, 0], root[dst, 2]
+    translation = np.stack([root[src, 0] - (c * x + s * z), root[src, 2] - (-s * x + c * z)], axis=-1)
+
+    return np.degrees(yaw), translation
+
+
+def write_csv(transitions, f):
+    writer = csv.writer(f)
+    writer.writerow(['from_file', 'from_frame', 'to_file', 'to_frame', 'distance', 'yaw', 'tx', 'tz'])
+
+    for t in transitions:
+        writer.writerow([t['from_file'], t['from_frame'], t['to_file'], t['to_frame'], t['distance'],
+                         t['yaw']] + t['translation'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Candidate motion graph transitions between BVH clips.')
+    parser.add_argument('paths', nargs='+', help='BVH files or directories searched recursively')
+    parser.add_argument('-o', '--output', help='output file, stdout by default')
+    parser.add_argument('-f', '--format', choices=['json', 'csv'],
+                        help='output format, guessed from --output and json by default')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--threshold', type=float,
+                        help='largest RMS joint distance, in skeleton units '
+                             '(default: %g of the skeleton size)' % THRESHOLD_RATIO)
+    parser.add_argument('--min-gap', type=int, default=MIN_FRAME_GAP,
+                        help='smallest frame distance of a transition within a clip')
+    parser.add_argument('--block', type=int, default=TRANSITION_BLOCK,
+                        help='rows & columns of the distance matrix computed at a time')
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+    clips = [load_bvh(filename) for filename in files]
+    if len(clips) == 0:
+        parser.error('no BVH files found')
+
+    # clips share one skeleton, its point clouds must be comparable
+    names = clips[0].skeleton.names
+    for filename, bvh in zip(files, clips):
+        if bvh.skeleton.names != names:
+            parser.error('%s has a different skeleton than %s' % (filename, files[0]))
+
+    start = time.perf_counter()
+    features = np.concatenate([pose_clouds(bvh) for bvh in clips])
+    clip_index = np.repeat(np.arange(len(clips)), [bvh.num_of_frames for bvh in clips])
+    first_frame = np.cumsum([0] + [bvh.num_of_frames for bvh in clips])
+    print('Features: %d frames x %d dims in %.2f s' % (
+        features.shape + (time.perf_counter() - start,)), file=sys.stderr)
+
+    threshold = args.threshold
+    if threshold is None:
+        threshold = THRESHOLD_RATIO * skeleton_size(clips[0].skeleton)
+
+    def progress(n, total):
+        print('[%d/%d] row blocks' % (n, total), file=sys.stderr)
+
+    start = time.perf_counter()
+    i, j, distance = find_transitions(features, clip_index, threshold, args.min_gap, args.block,
+                                      max(args.jobs, 1), progress)
+    print('%d local minima below %g in %.2f s' % (len(i), threshold, time.perf_counter() - start),
+          file=sys.stderr)
+
+    # both directions of every pair are transitions
+    src, dst = np.concatenate([i, j]), np.concatenate([j, i])
+    distance = np.concatenate([distance, distance])
+
+    motions = [root_motion(bvh.skeleton, bvh.motion) for bvh in clips]
+    root = np.concatenate([m[0] for m in motions])
+    facing = np.concatenate([m[1] for m in motions])
+    yaw, translation = alignments(root, facing, src, dst)
+
+    order = np.lexsort((dst, src))
+    transitions = [{
+        'from_file': files[clip_index[s]],
+        'from_frame': int(s - first_frame[clip_index[s]]),
+        'to_file': files[clip_index[d]],
+        'to_frame': int(d - first_frame[clip_index[d]]),
+        'distance': float(distance[k]),
+        'yaw': float(yaw[k]),
+        'translation': translation[k].tolist(),
+    } for k, s, d in zip(order, src[order], dst[order])]
+
+    write_output(transitions, args.output, output_format(args.format, args.output), write_csv)
+
+
+if __name__ == '__main__':
+    main()